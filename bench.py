@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+
+import ueil_tagger
+import ueil_tagger.bench
+
+
+PARSER = argparse.ArgumentParser(
+    prog=ueil_tagger.APP_NAME + " benchmark",
+    description="Measures how quickly members are tagged, by running the "
+                "full tagging pipeline against a local stand-in for the "
+                "ActionNetwork API and Nominatim geocoder, with synthetic "
+                "members. Prints members per second, requests per member, "
+                "request latency and peak memory use as JSON.")
+PARSER.add_argument(
+    "--members",
+    default=10000,
+    type=int,
+    help="The number of synthetic members in the mock database. "
+         "(default: %(default)s)")
+PARSER.add_argument(
+    "--page-size",
+    default=25,
+    type=int,
+    help="The number of records in each page of results returned by the "
+         "mock API. (default: %(default)s)")
+PARSER.add_argument(
+    "--latency",
+    default=0.0,
+    type=float,
+    help="The average time (in milliseconds) the mock ActionNetwork API "
+         "takes to respond to each request. (default: %(default)s)")
+PARSER.add_argument(
+    "--geocode-latency",
+    default=0.0,
+    type=float,
+    help="The average time (in milliseconds) the mock geocoder takes to "
+         "respond to each request. (default: %(default)s)")
+PARSER.add_argument(
+    "--error-rate",
+    default=0.0,
+    type=float,
+    help="The fraction of ActionNetwork requests (between 0 and 1) that "
+         "fail with a 503 response, and so have to be retried. "
+         "(default: %(default)s)")
+PARSER.add_argument(
+    "--max-in-flight",
+    default=0,
+    type=int,
+    help="If more than 0, the mock ActionNetwork API answers requests beyond "
+         "this many at once with a 429 response, like an API that's "
+         "throttling the client. (default: no limit)")
+PARSER.add_argument(
+    "--workers",
+    default=1,
+    type=int,
+    help="The number of members to update at the same time. "
+         "(default: %(default)s)")
+PARSER.add_argument(
+    "--prefetch-pages",
+    default=2,
+    type=int,
+    help="The number of pages of people records to request in the "
+         "background. (default: %(default)s)")
+PARSER.add_argument(
+    "--snapshot-taggings",
+    help="If provided, load everyone's ward taggings at the start of the "
+         "run, as with run.py --snapshot-taggings.",
+    default=False,
+    action="store_true")
+PARSER.add_argument(
+    "--requests-per-second",
+    default=None,
+    type=float,
+    help="If provided, limit requests to the mock ActionNetwork API to this "
+         "many per second, as 'max-requests-per-second' does in "
+         "'config.toml'. (default: no limit)")
+PARSER.add_argument(
+    "--max-concurrency",
+    default=None,
+    type=int,
+    help="If provided, adjust the number of requests to the mock "
+         "ActionNetwork API in flight at once, up to this many, as "
+         "'http-max-concurrency' does in 'config.toml'. (default: no limit)")
+PARSER.add_argument(
+    "--geocoder-requests-per-second",
+    default=1000.0,
+    type=float,
+    help="The most requests per second made to the mock geocoder. "
+         "(default: %(default)s)")
+PARSER.add_argument(
+    "--seed",
+    default=0,
+    type=int,
+    help="Seed for the mock API's latency and errors. (default: %(default)s)")
+PARSER.add_argument(
+    "--verbose", "-v",
+    action="count",
+    default=0,
+    help="If provided once, then print info messages. If provided two or "
+         "more times, then also print debug messages. (default: %(default)s)")
+ARGS = PARSER.parse_args()
+
+if ARGS.verbose == 0:
+    logging.basicConfig(level=logging.ERROR)
+elif ARGS.verbose == 1:
+    logging.basicConfig(level=logging.INFO)
+else:
+    logging.basicConfig(level=logging.DEBUG)
+
+OPTIONS = ueil_tagger.bench.MockApiOptions(
+    ARGS.members, ARGS.page_size, ARGS.latency / 1000,
+    ARGS.geocode_latency / 1000, ARGS.error_rate, ARGS.seed,
+    ARGS.max_in_flight)
+REPORT = ueil_tagger.bench.run_benchmark(
+    OPTIONS, ARGS.workers, ARGS.prefetch_pages, ARGS.snapshot_taggings,
+    ARGS.requests_per_second, ARGS.max_concurrency,
+    ARGS.geocoder_requests_per_second)
+print(REPORT.to_json())
@@ -1,16 +1,30 @@
 #!/usr/bin/env python3
 
 import argparse
+import contextlib
 import datetime
 import logging
+import pathlib
 import sys
 
 import ueil_tagger
 import ueil_tagger.cache
 import ueil_tagger.client
 import ueil_tagger.config
+import ueil_tagger.daemon
+import ueil_tagger.geolocate
+import ueil_tagger.impact
+import ueil_tagger.journal
+import ueil_tagger.local_geocoder
 import ueil_tagger.members
+import ueil_tagger.metrics
+import ueil_tagger.mirror
+import ueil_tagger.plan
+import ueil_tagger.profiling
+import ueil_tagger.shards
+import ueil_tagger.tracing
 import ueil_tagger.types
+import ueil_tagger.ward_data
 
 
 LAST_RUN_DATETIME = ueil_tagger.config.get_last_run()
@@ -75,8 +89,174 @@ PARSER.add_argument(
     "--uuid",
     nargs="*",
     help="If provided, then only the specified person records are loaded and "
-         "modified. In this case, the --since argument is ignored. "
+         "modified. In this case, the --since argument is ignored. Use '-' "
+         "to read uuids from stdin, one per line. (default: %(default)s)")
+PARSER.add_argument(
+    "--uuid-file",
+    type=pathlib.Path,
+    metavar="PATH",
+    help="Like --uuid, but reads the uuids from a file, one per line ('#' "
+         "starts a comment). Uuids are updated as they're read, by up to "
+         "--workers at a time. Use '-' to read from stdin.")
+PARSER.add_argument(
+    "--workers",
+    default=1,
+    type=int,
+    help="The number of members to update at the same time. Requests made by "
+         "all workers are limited by 'max-requests-per-second' (and "
+         "'http-max-concurrency') in 'config.toml'. (default: %(default)s)")
+PARSER.add_argument(
+    "--prefetch-pages",
+    default=2,
+    type=int,
+    help="The number of pages of people records to request in the "
+         "background, while earlier pages are being updated. "
          "(default: %(default)s)")
+PARSER.add_argument(
+    "--snapshot-taggings",
+    help="If provided, load the current ward taggings for everyone at the "
+         "start of the run, by paging through the taggings of each ward "
+         "tag, instead of requesting each member's taggings separately. "
+         "Makes far fewer requests when updating many members.",
+    default=False,
+    action="store_true"
+)
+PARSER.add_argument(
+    "--incremental",
+    help="If provided, skip members whose address and 'Aldermanic Ward' "
+         "fields haven't changed since they were last updated (and the ward "
+         "data and --min-sqft are the same). The fields last used for each "
+         "member are stored in 'app_state/'.",
+    default=False,
+    action="store_true"
+)
+PARSER.add_argument(
+    "--resume",
+    help="If provided, continue the last run that didn't finish (e.g., "
+         "because of an API outage) from where it stopped, using the journal "
+         "in 'app_state/'. In this case, the --since argument is ignored.",
+    default=False,
+    action="store_true"
+)
+PARSER.add_argument(
+    "--shard",
+    metavar="K/N",
+    help="If provided, only update the members in shard K of N (numbered "
+         "from 0), so that a run can be split between N processes or hosts. "
+         "Each shard has its own batch cache and journal, and writes its "
+         "summary to 'app_state/shards/' when it finishes, instead of "
+         "updating the last run date. When running shards on several hosts, "
+         "give every shard the same --since date.")
+PARSER.add_argument(
+    "--run-id",
+    metavar="ID",
+    help="If provided with --shard, record this id with the shard's "
+         "summary (give every shard of a run the same id). If provided with "
+         "--merge-shards, only combine the summaries recorded with this id.")
+PARSER.add_argument(
+    "--merge-shards",
+    nargs="*",
+    type=pathlib.Path,
+    metavar="PATH",
+    help="If provided, combine the summaries written by each shard of a "
+         "run (by default, those in 'app_state/shards/') and print the "
+         "result. The last run date is only updated if there is a summary "
+         "from every shard, in which case it is set to when the first shard "
+         "started, and the summaries that were combined are then removed.")
+PARSER.add_argument(
+    "--serve",
+    metavar="[HOST:]PORT",
+    help="If provided, keep running, and update each person sent to the "
+         "given port (on 127.0.0.1 unless a host is given), either as a "
+         "person record POSTed to '/people', or as an ActionNetwork webhook "
+         "POSTed to '/webhook' (see 'serve-secret' in the config file). "
+         "The ward data, ward tags and API connections are kept loaded "
+         "between updates. '/status' reports the queue length and a summary "
+         "of the updates so far. The last run date isn't updated, so a "
+         "periodic full run is still needed to catch any missed changes.")
+PARSER.add_argument(
+    "--debounce-secs",
+    default=ueil_tagger.daemon.DEBOUNCE_SECS,
+    type=float,
+    help="With --serve, how long to wait for further changes to a person "
+         "before updating them. (default: %(default)s)")
+PARSER.add_argument(
+    "--sync",
+    help="If provided, copy the people updated since the last sync (or "
+         "everyone, the first time), and their current ward taggings, into "
+         "the local mirror at 'app_state/mirror.sqlite3'. Only the fields "
+         "used to pick each member's wards are kept. Unless --from-mirror "
+         "is also given, no taggings are changed.",
+    default=False,
+    action="store_true"
+)
+PARSER.add_argument(
+    "--from-mirror",
+    help="If provided, update every member in the local mirror (after "
+         "syncing it, with --sync), instead of requesting members from the "
+         "API. Each member's wards are worked out from the mirror, and only "
+         "the taggings that need to change are sent to the API, which makes "
+         "re-tagging everyone (e.g., after changing --min-sqft or the ward "
+         "data) much faster. The last run date isn't updated.",
+    default=False,
+    action="store_true"
+)
+PARSER.add_argument(
+    "--boundary-impact",
+    type=pathlib.Path,
+    metavar="OLD_DATA",
+    help="If provided, compare the ward data in 'data/' with the given old "
+         "ward data (a copy of the old 'data/' directory, or just the old "
+         "'wards.json'), print the uuids of the members in the local mirror "
+         "(see --sync) whose wards may have changed, one per line, and then "
+         "exit. Addresses are checked using their cached coordinates, and "
+         "zipcodes using --min-sqft, so nobody is geocoded. The output can "
+         "be given to --uuid-file, so that only those members are updated.")
+PARSER.add_argument(
+    "--plan",
+    type=pathlib.Path,
+    metavar="PATH",
+    help="If provided, work out the tagging changes needed for each member, "
+         "and write them to the given file (one JSON object per line) "
+         "instead of making them. The changes can then be reviewed, and "
+         "made later with --apply.")
+PARSER.add_argument(
+    "--apply",
+    type=pathlib.Path,
+    metavar="PATH",
+    help="If provided, make the tagging changes in a file written by --plan "
+         "(using --workers workers), instead of looking up any members. Any "
+         "changes that fail are written to '<PATH stem>.failed.jsonl', so "
+         "that they can be retried with --apply.")
+PARSER.add_argument(
+    "--metrics-out",
+    type=pathlib.Path,
+    metavar="PATH",
+    help="If provided, also write the run summary, and the time, request "
+         "count, bytes transferred and retries of each stage of the run, to "
+         "the given file in the Prometheus text format (e.g., for the node "
+         "exporter's textfile collector). The same stage metrics are always "
+         "included in the printed summary.")
+PARSER.add_argument(
+    "--profile",
+    nargs="?",
+    const="cprofile",
+    choices=["cprofile", "sample"],
+    help="If provided, profile the run, either by recording every function "
+         "call with cProfile, or (with 'sample') by sampling the stack of "
+         "every thread every few milliseconds, which slows the run down "
+         "much less. Also records how long is spent in each traced span "
+         "(e.g., geocoding, or each kind of API request). Unless "
+         "--profile-out is given, the slowest functions and spans are "
+         "printed to stderr.")
+PARSER.add_argument(
+    "--profile-out",
+    type=pathlib.Path,
+    metavar="PATH",
+    help="If provided, write the profile to the given file (implies "
+         "--profile), as a pstats file for 'cprofile', or as collapsed "
+         "stacks (for flame graph tools) for 'sample'. Spans are written as "
+         "collapsed stacks to '<PATH>.spans'.")
 PARSER.add_argument(
     "--dry-run",
     help="Don't make any changes to the database, just print information as "
@@ -85,6 +265,14 @@ PARSER.add_argument(
     action="store_true",
     default=False
 )
+PARSER.add_argument(
+    "--compile-ward-data",
+    help="Compile the ward and zipcode data in 'data/' into the binary "
+         "format loaded at startup, and then exit. (The compiled data is "
+         "also rebuilt automatically whenever the source data changes.)",
+    action="store_true",
+    default=False
+)
 PARSER.add_argument(
     "--verbose", "-v",
     action="count",
@@ -101,27 +289,216 @@ elif ARGS.verbose == 1:
 else:
     logging.basicConfig(level=logging.DEBUG)
 
+if ARGS.compile_ward_data:
+    ueil_tagger.ward_data.compile_ward_data()
+    sys.exit(0)
+
+if ARGS.merge_shards is not None:
+    SHARD_RESULT_PATHS = (ARGS.merge_shards or
+                          ueil_tagger.shards.find_shard_results())
+    try:
+        SHARD_RESULTS = [ueil_tagger.shards.ShardResult.load(path)
+                         for path in SHARD_RESULT_PATHS]
+        if ARGS.run_id:
+            SHARD_RESULT_PATHS, SHARD_RESULTS = (
+                [path for path, result in zip(SHARD_RESULT_PATHS,
+                                              SHARD_RESULTS)
+                 if result.run_id == ARGS.run_id],
+                [result for result in SHARD_RESULTS
+                 if result.run_id == ARGS.run_id])
+        MERGED_SUMMARY, FIRST_STARTED_AT = (
+            ueil_tagger.shards.merge_shard_results(SHARD_RESULTS))
+    except (OSError, ValueError, TypeError) as e:
+        logging.error("Unable to merge shard results: %s", e)
+        sys.exit(1)
+    if not ARGS.dry_run:
+        ueil_tagger.config.set_last_run(FIRST_STARTED_AT)
+        ueil_tagger.shards.remove_shard_results(SHARD_RESULT_PATHS)
+    print(MERGED_SUMMARY.to_json())
+    sys.exit(0)
+
+if ARGS.boundary_impact:
+    if not ARGS.boundary_impact.exists():
+        logging.error("No ward data found at '%s'", ARGS.boundary_impact)
+        sys.exit(1)
+    with ueil_tagger.mirror.MemberMirror() as MIRROR:
+        MIRRORED_MEMBERS = MIRROR.members()
+    if not MIRRORED_MEMBERS:
+        logging.error("The mirror is empty, so there's no one to check (use "
+                      "--sync to fill it)")
+        sys.exit(1)
+    IMPACT = ueil_tagger.impact.members_affected_by_ward_data_change(
+        ueil_tagger.impact.load_old_ward_data(ARGS.boundary_impact),
+        ueil_tagger.ward_data.get_ward_data(), MIRRORED_MEMBERS,
+        ARGS.min_sqft, ueil_tagger.cache.get_tagger_cache())
+    for PERSON_UUID in IMPACT.person_uuids():
+        print(PERSON_UUID)
+    sys.exit(0)
+
+SHARD = None
+if ARGS.shard:
+    try:
+        SHARD = ueil_tagger.types.Shard.parse(ARGS.shard)
+    except ValueError:
+        logging.error("Invalid --shard '%s', must be K/N, with K from 0 to "
+                      "N - 1", ARGS.shard)
+        sys.exit(1)
+    if ARGS.uuid or ARGS.uuid_file or ARGS.apply:
+        logging.error("--shard can't be used with --uuid, --uuid-file or "
+                      "--apply")
+        sys.exit(1)
+elif ARGS.run_id:
+    logging.error("--run-id can only be used with --shard or --merge-shards")
+    sys.exit(1)
+
+SERVE_HOST, SERVE_PORT = "127.0.0.1", 0
+if ARGS.serve:
+    if (ARGS.uuid or ARGS.uuid_file or ARGS.apply or ARGS.plan or
+            ARGS.shard or ARGS.resume):
+        logging.error("--serve can't be used with --uuid, --uuid-file, "
+                      "--apply, --plan, --shard or --resume")
+        sys.exit(1)
+    SERVE_HOST_TEXT, _, SERVE_PORT_TEXT = ARGS.serve.rpartition(":")
+    try:
+        SERVE_PORT = int(SERVE_PORT_TEXT)
+    except ValueError:
+        logging.error("Invalid --serve address '%s'", ARGS.serve)
+        sys.exit(1)
+    SERVE_HOST = SERVE_HOST_TEXT or SERVE_HOST
+
+if ARGS.workers < 1:
+    logging.error("--workers must be at least 1")
+    sys.exit(1)
+
+if ARGS.resume and (ARGS.dry_run or ARGS.uuid or ARGS.uuid_file):
+    logging.error("--resume can't be used with --dry-run, --uuid or "
+                  "--uuid-file")
+    sys.exit(1)
+
+if ARGS.plan and (ARGS.resume or ARGS.uuid or ARGS.uuid_file or ARGS.apply or
+                  ARGS.batch):
+    logging.error("--plan can't be used with --resume, --uuid, --uuid-file, "
+                  "--apply or --batch")
+    sys.exit(1)
+
+if (ARGS.sync or ARGS.from_mirror) and (
+        ARGS.uuid or ARGS.uuid_file or ARGS.apply or ARGS.serve or
+        ARGS.shard or ARGS.resume or ARGS.batch):
+    logging.error("--sync and --from-mirror can't be used with --uuid, "
+                  "--uuid-file, --apply, --serve, --shard, --resume or "
+                  "--batch")
+    sys.exit(1)
+
+if ARGS.plan and ARGS.sync and not ARGS.from_mirror:
+    logging.error("--plan can only be used with --sync if --from-mirror is "
+                  "also given")
+    sys.exit(1)
+
+if ARGS.uuid and ARGS.uuid_file:
+    logging.error("--uuid can't be used with --uuid-file")
+    sys.exit(1)
+
+if (ARGS.uuid_file and str(ARGS.uuid_file) != "-" and
+        not ARGS.uuid_file.is_file()):
+    logging.error("No uuid file found at '%s'", ARGS.uuid_file)
+    sys.exit(1)
+
+if ARGS.apply and not ARGS.apply.is_file():
+    logging.error("No plan file found at '%s'", ARGS.apply)
+    sys.exit(1)
+
 if not ARGS.api_key:
     logging.error("Must provide an API key, either with --api-key or "
                   "in 'config.toml'")
     sys.exit(1)
 
-CLIENT = ueil_tagger.client.Client(ARGS.api_key, ARGS.dry_run)
+CLIENT = ueil_tagger.client.Client(
+    ARGS.api_key, ARGS.dry_run,
+    pool_size=max(ueil_tagger.config.get_http_pool_size(), ARGS.workers),
+    max_retries=ueil_tagger.config.get_http_max_retries(),
+    backoff_factor=ueil_tagger.config.get_http_backoff_factor(),
+    connect_timeout=ueil_tagger.config.get_http_connect_timeout(),
+    read_timeout=ueil_tagger.config.get_http_read_timeout(),
+    requests_per_second=ueil_tagger.config.get_max_requests_per_second(),
+    max_concurrency=ueil_tagger.config.get_http_max_concurrency())
+GEOCODER_BACKEND: ueil_tagger.geolocate.GeocoderBackend
+GEOCODER_BACKEND = ueil_tagger.geolocate.NominatimBackend(
+    ueil_tagger.config.get_geocoder_url(),
+    ueil_tagger.config.get_geocoder_requests_per_second(),
+    ueil_tagger.config.get_geocoder_timeout())
+ADDRESS_POINTS_PATH = ueil_tagger.config.get_local_address_points_path()
+if ADDRESS_POINTS_PATH:
+    if not ADDRESS_POINTS_PATH.is_file():
+        logging.error("No address points file found at '%s'",
+                      ADDRESS_POINTS_PATH)
+        sys.exit(1)
+    GEOCODER_BACKEND = ueil_tagger.local_geocoder.FallbackBackend(
+        ueil_tagger.local_geocoder.LocalAddressBackend(
+            ueil_tagger.local_geocoder.LocalAddressIndex(ADDRESS_POINTS_PATH)),
+        GEOCODER_BACKEND)
+ueil_tagger.geolocate.configure_geocoder(
+    GEOCODER_BACKEND,
+    ueil_tagger.config.get_failed_address_ttl_days() * 24 * 60 * 60)
 UPDATED_SINCE = None
 SUMMARY = None
 
+PROFILER = None
+if ARGS.profile or ARGS.profile_out:
+    PROFILER = ueil_tagger.profiling.get_profiler(ARGS.profile or "cprofile")
+    ueil_tagger.tracing.get_tracer().enable()
+    PROFILER.start()
+
+if SHARD:
+    ueil_tagger.cache.get_tagger_cache().use_batch_namespace(SHARD.name)
+
 if ARGS.clear_batch_cache:
     logging.info("Clearing batch cache")
-    CACHE = ueil_tagger.cache.TaggerCache()
-    CACHE.clear_member_uuid_cache()
-
-if ARGS.uuid:
-    for person_uuid in ARGS.uuid:
-        SUMMARY = ueil_tagger.members.set_ward_tags_for_member_uuid(
-                CLIENT, person_uuid, ARGS.min_sqft, SUMMARY)
-        if SUMMARY.encountered_error():
-            sys.exit(1)
+    ueil_tagger.cache.get_tagger_cache().clear_member_uuid_cache()
+
+if ARGS.serve:
+    SERVICE = ueil_tagger.daemon.TaggingService(
+        CLIENT, ARGS.min_sqft, ARGS.debounce_secs, ARGS.incremental)
+    ueil_tagger.daemon.serve(SERVICE, SERVE_HOST, SERVE_PORT, ARGS.workers,
+                             ueil_tagger.config.get_serve_secret())
+    SUMMARY = SERVICE.summary
+elif ARGS.sync or ARGS.from_mirror:
+    with ueil_tagger.mirror.MemberMirror() as MIRROR:
+        if ARGS.sync:
+            ueil_tagger.mirror.sync_mirror(CLIENT, MIRROR, ARGS.workers,
+                                           ARGS.prefetch_pages)
+        SUMMARY = ueil_tagger.types.TaggingsSummary()
+        if ARGS.from_mirror:
+            MIRROR_PLAN_WRITER = None
+            if ARGS.plan:
+                MIRROR_PLAN_WRITER = ueil_tagger.plan.PlanWriter(ARGS.plan)
+            SUMMARY = ueil_tagger.mirror.set_ward_tags_for_mirrored_members(
+                CLIENT, MIRROR, ARGS.min_sqft, ARGS.workers,
+                ARGS.incremental, MIRROR_PLAN_WRITER)
+            if MIRROR_PLAN_WRITER:
+                MIRROR_PLAN_WRITER.close(SUMMARY)
+elif ARGS.apply:
+    SUMMARY = ueil_tagger.plan.apply_plan(CLIENT, ARGS.apply, ARGS.workers)
+elif ARGS.uuid or ARGS.uuid_file:
+    with contextlib.ExitStack() as UUID_STACK:
+        if ARGS.uuid == ["-"] or str(ARGS.uuid_file) == "-":
+            UUIDS = ueil_tagger.members.read_person_uuids(sys.stdin)
+        elif ARGS.uuid_file:
+            UUIDS = ueil_tagger.members.read_person_uuids(
+                UUID_STACK.enter_context(ARGS.uuid_file.open()))
+        else:
+            UUIDS = iter(ARGS.uuid)
+        SUMMARY = ueil_tagger.members.set_ward_tags_for_member_uuids(
+            CLIENT, UUIDS, ARGS.min_sqft, ARGS.workers, ARGS.incremental)
 else:
+    JOURNAL = None
+    JOURNAL_PATH = ueil_tagger.journal.journal_path(SHARD)
+    if ARGS.resume:
+        JOURNAL = ueil_tagger.journal.RunJournal.load(JOURNAL_PATH)
+        if not JOURNAL:
+            logging.error("No unfinished run to resume")
+            sys.exit(1)
+        ARGS.since = JOURNAL.since
+
     if ARGS.since:
         try:
             UPDATED_SINCE = datetime.datetime.fromisoformat(ARGS.since)
@@ -137,12 +514,54 @@ else:
                           ARGS.since)
             sys.exit(1)
 
+    if not JOURNAL and not ARGS.dry_run and not ARGS.plan:
+        if ueil_tagger.journal.RunJournal.load(JOURNAL_PATH):
+            logging.info("Discarding the journal of an earlier unfinished "
+                         "run (use --resume to continue it instead)")
+        JOURNAL = ueil_tagger.journal.RunJournal(
+            UPDATED_SINCE.isoformat() if UPDATED_SINCE else None,
+            datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            path=JOURNAL_PATH)
+    STARTED_AT = (JOURNAL.started_at if JOURNAL else
+                  datetime.datetime.now(datetime.timezone.utc).isoformat())
+
+    PLAN_WRITER = None
+    if ARGS.plan:
+        PLAN_WRITER = ueil_tagger.plan.PlanWriter(ARGS.plan)
+
     SUMMARY = ueil_tagger.members.set_ward_tags_for_all_members_since(
-        CLIENT, ARGS.min_sqft, ARGS.batch, UPDATED_SINCE)
-    if not ARGS.dry_run:
-        NOW_UTC_TIME = datetime.datetime.now(datetime.timezone.utc)
-        ueil_tagger.config.set_last_run(NOW_UTC_TIME)
+        CLIENT, ARGS.min_sqft, ARGS.batch, UPDATED_SINCE, ARGS.workers,
+        ARGS.snapshot_taggings, ARGS.prefetch_pages, ARGS.incremental,
+        JOURNAL, PLAN_WRITER, SHARD)
+    if PLAN_WRITER:
+        PLAN_WRITER.close(SUMMARY)
+    # Members aren't up to date until a plan has been applied, so the next
+    # run has to look at them again. The last run date of a sharded run is
+    # only updated once the results of every shard are merged.
+    if SHARD and not ARGS.dry_run and not ARGS.plan:
+        ueil_tagger.shards.ShardResult(
+            str(SHARD), UPDATED_SINCE.isoformat() if UPDATED_SINCE else None,
+            STARTED_AT,
+            datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            SUMMARY.to_dict(), ARGS.run_id).save(
+                ueil_tagger.shards.shard_result_path(SHARD))
+    elif not ARGS.dry_run and not ARGS.plan:
+        # A resumed run only re-reads the pages it hadn't finished, so the
+        # next run has to look for changes since the original run started.
+        ueil_tagger.config.set_last_run(
+            datetime.datetime.fromisoformat(STARTED_AT))
 
 assert SUMMARY
+if PROFILER:
+    PROFILER.stop()
+    ueil_tagger.profiling.write_profile(PROFILER, ARGS.profile_out)
+SUMMARY.address_cache = ueil_tagger.cache.get_tagger_cache().address_stats()
+SUMMARY.metrics = ueil_tagger.metrics.get_metrics().snapshot()
+SUMMARY.concurrency = CLIENT.concurrency_stats()
+if ARGS.metrics_out:
+    ueil_tagger.metrics.write_prometheus_textfile(SUMMARY, ARGS.metrics_out)
 print(SUMMARY.to_json())
+# Updating people by uuid carries on past errors, but still reports them.
+if (ARGS.uuid or ARGS.uuid_file) and SUMMARY.encountered_error():
+    sys.exit(1)
 sys.exit(0)
@@ -0,0 +1,57 @@
+from __future__ import annotations
+
+import requests
+
+from ueil_tagger.client import request_outcome
+from ueil_tagger.concurrency import ConcurrencyLimiter, MIN_WINDOW_SIZE
+from ueil_tagger.concurrency import RequestOutcome
+
+
+# Sends a window's worth of requests, all in flight at once, the first
+# num_errors of which fail.
+def send_window(limiter: ConcurrencyLimiter, num_errors: int = 0) -> None:
+    for _ in range(max(limiter.limit, MIN_WINDOW_SIZE) // limiter.limit):
+        started = [limiter.acquire() for _ in range(limiter.limit)]
+        for started_at in started:
+            outcome = RequestOutcome.OK
+            if num_errors:
+                outcome = RequestOutcome.ERROR
+                num_errors -= 1
+            limiter.release(started_at, outcome, 0.01)
+
+
+def test_server_errors_lower_the_limit() -> None:
+    limiter = ConcurrencyLimiter(32, initial_limit=10)
+    send_window(limiter, num_errors=3)
+    assert limiter.limit == 5
+    stats = limiter.snapshot()
+    assert stats.error_events == 1
+    assert stats.throttle_events == 0
+    assert stats.latency_events == 0
+
+
+def test_server_errors_stop_increases() -> None:
+    limiter = ConcurrencyLimiter(32, initial_limit=10)
+    send_window(limiter)
+    assert limiter.limit == 11
+    for _ in range(5):
+        send_window(limiter, num_errors=limiter.limit)
+    assert limiter.limit == 1
+    assert limiter.snapshot().increases == 1
+
+
+def test_few_server_errors_still_allow_increases() -> None:
+    limiter = ConcurrencyLimiter(32, initial_limit=10)
+    send_window(limiter, num_errors=1)
+    assert limiter.limit == 11
+    assert limiter.snapshot().error_events == 0
+
+
+def test_5xx_response_is_an_error() -> None:
+    rs = requests.Response()
+    rs.status_code = 503
+    assert request_outcome(rs) == RequestOutcome.ERROR
+    rs.status_code = 404
+    assert request_outcome(rs) == RequestOutcome.OTHER
+    rs.status_code = 200
+    assert request_outcome(rs) == RequestOutcome.OK
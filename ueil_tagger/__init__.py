@@ -1,5 +1,5 @@
 __author__ = "Peter Snyder"
-__version__ = "0.4"
+__version__ = "0.5"
 
 
 from pathlib import Path
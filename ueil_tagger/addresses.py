@@ -0,0 +1,56 @@
+import re
+
+from ueil_tagger.types import StreetAddress
+
+
+DIRECTION_ABBREVIATIONS = {
+    "north": "n",
+    "south": "s",
+    "east": "e",
+    "west": "w",
+    "northeast": "ne",
+    "northwest": "nw",
+    "southeast": "se",
+    "southwest": "sw",
+}
+
+STREET_SUFFIX_ABBREVIATIONS = {
+    "avenue": "ave",
+    "av": "ave",
+    "boulevard": "blvd",
+    "circle": "cir",
+    "court": "ct",
+    "drive": "dr",
+    "expressway": "expy",
+    "highway": "hwy",
+    "lane": "ln",
+    "parkway": "pkwy",
+    "place": "pl",
+    "road": "rd",
+    "square": "sq",
+    "street": "st",
+    "terrace": "ter",
+}
+
+OTHER_ABBREVIATIONS = {
+    "apartment": "apt",
+    "suite": "ste",
+    "illinois": "il",
+}
+
+ADDRESS_ABBREVIATIONS = (DIRECTION_ABBREVIATIONS |
+                         STREET_SUFFIX_ABBREVIATIONS |
+                         OTHER_ABBREVIATIONS)
+
+PUNCTUATION_RE = re.compile(r"[.,#;]")
+
+
+def address_tokens(address: StreetAddress) -> list[str]:
+    text = PUNCTUATION_RE.sub(" ", address.lower())
+    return [ADDRESS_ABBREVIATIONS.get(token, token) for token in text.split()]
+
+
+# Reduces an address to a canonical form, so that (for example)
+# "123 N Main St" and "123 north main street." compare as equal.
+def normalize_address(address: StreetAddress) -> StreetAddress:
+    return " ".join(address_tokens(address))
@@ -0,0 +1,476 @@
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import json
+import logging
+import math
+import multiprocessing
+from pathlib import Path
+import random
+import resource
+import tempfile
+import threading
+import time
+from typing import Any, Optional, TYPE_CHECKING
+from urllib.parse import parse_qs, urlsplit
+import zlib
+
+import numpy as np
+import requests
+
+from ueil_tagger.cache import TaggerCache
+from ueil_tagger.client import Client
+from ueil_tagger.geolocate import configure_geocoder, NominatimBackend
+from ueil_tagger.members import set_ward_tags_for_all_members_since
+from ueil_tagger.metrics import get_metrics
+from ueil_tagger.ward_data import get_ward_data
+
+if TYPE_CHECKING:
+    from multiprocessing.connection import Connection
+    from ueil_tagger.types import TaggingsSummary, WebAPIRecord
+
+
+API_PATH = "/api/v2"
+STATS_PATH = "/_stats"
+NUM_WARDS = 50
+# Tags that aren't ward tags, so that the ward tags have to be picked out
+# of the tag list, like in the real database.
+NUM_OTHER_TAGS = 10
+MODIFIED_DATE = "2024-01-01T00:00:00+00:00"
+
+# The ActionNetwork endpoints used by the client, by request method, the
+# constant parts of the path, and the number of path parts.
+ROUTES = {
+    ("GET", ("people",), 1): "list people",
+    ("GET", ("people",), 2): "get person",
+    ("GET", ("people", "taggings"), 3): "get person taggings",
+    ("GET", ("tags",), 1): "list tags",
+    ("GET", ("tags", "taggings"), 3): "get tag taggings",
+    ("POST", ("tags", "taggings"), 3): "add tagging",
+    ("DELETE", ("tags", "taggings"), 4): "delete tagging",
+}
+GEOCODE_ROUTE = "geocode"
+
+
+@dataclass
+class MockApiOptions:
+    num_members: int
+    page_size: int = 25
+    # Mean delay (in seconds) added to each ActionNetwork and geocoder
+    # response.
+    latency: float = 0.0
+    geocode_latency: float = 0.0
+    # Fraction of ActionNetwork requests that fail with a 503 response
+    # (which the client retries).
+    error_rate: float = 0.0
+    seed: int = 0
+    # If more than 0, ActionNetwork requests beyond this many at once are
+    # throttled with a 429 response (which the client retries).
+    max_in_flight: int = 0
+
+
+def person_uuid(person_index: int) -> str:
+    return f"person-{person_index:07d}"
+
+
+def person_index(uuid: str) -> int:
+    return int(uuid.rsplit("-", 1)[-1])
+
+
+def ward_tag_uuid(ward_num: int) -> str:
+    return f"ward-tag-{ward_num:02d}"
+
+
+# Members are generated from their index, so that no member records need
+# to be stored. 40% give their ward, 50% give a street address, and the
+# rest only give a zipcode.
+def synthetic_person(index: int, zipcodes: list[str]) -> WebAPIRecord:
+    zipcode = zipcodes[index % len(zipcodes)]
+    address: dict[str, Any] = {"postal_code": zipcode}
+    custom_fields: dict[str, str] = {}
+    kind = index % 10
+    if kind < 4:
+        custom_fields["Aldermanic Ward"] = str(index % NUM_WARDS + 1)
+    elif kind < 9:
+        address["address_lines"] = [
+            f"{100 + index % 9900} W Benchmark {index} St"]
+        address["locality"] = "Chicago"
+        address["region"] = "IL"
+    return {
+        "identifiers": [f"action_network:{person_uuid(index)}"],
+        "postal_addresses": [address],
+        "custom_fields": custom_fields,
+        "modified_date": MODIFIED_DATE,
+    }
+
+
+# A third of members start out with a (usually wrong) ward tagging, so
+# that runs have taggings to both add and remove.
+def initial_ward_tag(index: int) -> Optional[int]:
+    if index % 3 != 0:
+        return None
+    return (index * 7) % NUM_WARDS + 1
+
+
+class MockActionNetwork:
+    options: MockApiOptions
+    zipcodes: list[str]
+    # Centers of the ward grid cells that are entirely inside a ward, which
+    # geocoded addresses are spread across.
+    geocode_points: list[tuple[float, float]]
+    lock: threading.Lock
+    random: random.Random
+    # Ward taggings by tag, and tag by person. Only people with taggings are
+    # stored, in the order they were tagged (to page through them).
+    tag_people: dict[str, dict[int, None]]
+    person_tags: dict[int, set[str]]
+    request_counts: dict[str, int]
+    injected_errors: int
+    in_flight: int
+    throttled_requests: int
+
+    def __init__(self, options: MockApiOptions, zipcodes: list[str],
+                 geocode_points: list[tuple[float, float]]) -> None:
+        self.options = options
+        self.zipcodes = zipcodes
+        self.geocode_points = geocode_points
+        self.lock = threading.Lock()
+        self.random = random.Random(options.seed)
+        self.tag_people = {ward_tag_uuid(w): {}
+                           for w in range(1, NUM_WARDS + 1)}
+        self.person_tags = {}
+        self.request_counts = {}
+        self.injected_errors = 0
+        self.in_flight = 0
+        self.throttled_requests = 0
+        for index in range(options.num_members):
+            ward_num = initial_ward_tag(index)
+            if ward_num:
+                self.add_tagging(ward_tag_uuid(ward_num), index)
+
+    def add_tagging(self, tag_uuid: str, index: int) -> None:
+        self.tag_people.setdefault(tag_uuid, {})[index] = None
+        self.person_tags.setdefault(index, set()).add(tag_uuid)
+
+    def remove_tagging(self, tag_uuid: str, index: int) -> None:
+        self.tag_people.get(tag_uuid, {}).pop(index, None)
+        self.person_tags.get(index, set()).discard(tag_uuid)
+
+    def count_request(self, route: str) -> bool:
+        with self.lock:
+            self.request_counts[route] = self.request_counts.get(route, 0) + 1
+            if route == GEOCODE_ROUTE:
+                return True
+            if self.random.random() < self.options.error_rate:
+                self.injected_errors += 1
+                return False
+        return True
+
+    def delay(self, mean_secs: float) -> None:
+        if mean_secs > 0:
+            time.sleep(self.random.uniform(0.5, 1.5) * mean_secs)
+
+    def page(self, items: list[Any],
+             page_index: int) -> tuple[list[Any], int]:
+        page_size = self.options.page_size
+        total_pages = max(1, math.ceil(len(items) / page_size))
+        start = (page_index - 1) * page_size
+        return items[start:start + page_size], total_pages
+
+    def people_page(self, page_index: int) -> WebAPIRecord:
+        num_members = self.options.num_members
+        page_size = self.options.page_size
+        start = min((page_index - 1) * page_size, num_members)
+        end = min(start + page_size, num_members)
+        records = [synthetic_person(i, self.zipcodes)
+                   for i in range(start, end)]
+        return {
+            "total_pages": max(1, math.ceil(num_members / page_size)),
+            "page": page_index,
+            "_embedded": {"osdi:people": records},
+        }
+
+    def tags_page(self, page_index: int) -> WebAPIRecord:
+        tags = [{"name": f"Chicago Ward {w}",
+                 "identifiers": [f"action_network:{ward_tag_uuid(w)}"]}
+                for w in range(1, NUM_WARDS + 1)]
+        tags += [{"name": f"Other Tag {n}",
+                  "identifiers": [f"action_network:other-tag-{n}"]}
+                 for n in range(NUM_OTHER_TAGS)]
+        records, total_pages = self.page(tags, page_index)
+        return {"total_pages": total_pages,
+                "_embedded": {"osdi:tags": records}}
+
+    def person_taggings(self, uuid: str) -> WebAPIRecord:
+        with self.lock:
+            tag_uuids = sorted(self.person_tags.get(person_index(uuid), ()))
+        taggings = [{"_links": {"osdi:tag": {
+                        "href": f"{API_PATH}/tags/{tag_uuid}"}}}
+                    for tag_uuid in tag_uuids]
+        return {"total_pages": 1,
+                "_embedded": {"osdi:taggings": taggings}}
+
+    def tag_taggings(self, tag_uuid: str, page_index: int) -> WebAPIRecord:
+        page_size = self.options.page_size
+        with self.lock:
+            people = self.tag_people.get(tag_uuid, {})
+            total_pages = max(1, math.ceil(len(people) / page_size))
+            start = (page_index - 1) * page_size
+            indexes = list(itertools.islice(people, start,
+                                            start + page_size))
+        taggings = [{"_links": {"osdi:person": {
+                        "href": f"{API_PATH}/people/{person_uuid(i)}"}}}
+                    for i in indexes]
+        return {"total_pages": total_pages,
+                "_embedded": {"osdi:taggings": taggings}}
+
+    def geocode(self, address: str) -> list[dict[str, str]]:
+        point_index = zlib.crc32(address.encode()) % len(self.geocode_points)
+        long, lat = self.geocode_points[point_index]
+        return [{"lat": str(lat), "lon": str(long), "display_name": address}]
+
+    # Returns False if there are already too many requests in flight.
+    def start_request(self) -> bool:
+        with self.lock:
+            max_in_flight = self.options.max_in_flight
+            if max_in_flight and self.in_flight >= max_in_flight:
+                self.throttled_requests += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def finish_request(self) -> None:
+        with self.lock:
+            self.in_flight -= 1
+
+    def stats(self) -> dict[str, Any]:
+        with self.lock:
+            return {"requests": dict(self.request_counts),
+                    "injected_errors": self.injected_errors,
+                    "throttled_requests": self.throttled_requests}
+
+
+class MockApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+    api: MockActionNetwork
+
+    def __init__(self, api: MockActionNetwork) -> None:
+        super().__init__(("127.0.0.1", 0), MockApiRequestHandler)
+        self.api = api
+
+
+class MockApiRequestHandler(BaseHTTPRequestHandler):
+    # Keep connections open, like the real APIs, so that the client's
+    # connection pool is used (and send responses immediately, instead of
+    # waiting on the client to acknowledge the headers).
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    server: MockApiServer
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def send_json(self, status: int, body: Any) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_request(self, method: str) -> None:
+        api = self.server.api
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        page_index = int(query.get("page", ["1"])[0])
+        content_length = int(self.headers.get("Content-Length", 0))
+        data = json.loads(self.rfile.read(content_length) or b"{}")
+
+        if url.path == STATS_PATH:
+            self.send_json(200, api.stats())
+            return
+        if url.path == "/search":
+            api.count_request(GEOCODE_ROUTE)
+            api.delay(api.options.geocode_latency)
+            self.send_json(200, api.geocode(query.get("q", [""])[0]))
+            return
+
+        parts = url.path.removeprefix(API_PATH).strip("/").split("/")
+        route = ROUTES.get((method, tuple(parts[0::2]), len(parts)))
+        if not route:
+            self.send_json(404, {"error": f"Unknown endpoint {url.path}"})
+            return
+
+        if not api.start_request():
+            self.send_json(429, {"error": "Too many requests"})
+            return
+        try:
+            self.handle_api_request(route, parts, page_index, data)
+        finally:
+            api.finish_request()
+
+    def handle_api_request(self, route: str, parts: list[str],
+                           page_index: int, data: Any) -> None:
+        api = self.server.api
+        succeeded = api.count_request(route)
+        api.delay(api.options.latency)
+        if not succeeded:
+            self.send_json(503, {"error": "Injected error"})
+            return
+
+        body: WebAPIRecord = {}
+        if route == "list people":
+            body = api.people_page(page_index)
+        elif route == "get person":
+            body = synthetic_person(person_index(parts[1]), api.zipcodes)
+        elif route == "get person taggings":
+            body = api.person_taggings(parts[1])
+        elif route == "list tags":
+            body = api.tags_page(page_index)
+        elif route == "get tag taggings":
+            body = api.tag_taggings(parts[1], page_index)
+        elif route == "add tagging":
+            person_href = data["_links"]["osdi:person"]["href"]
+            with api.lock:
+                api.add_tagging(parts[1], person_index(person_href))
+        elif route == "delete tagging":
+            with api.lock:
+                api.remove_tagging(parts[1], person_index(parts[3]))
+        self.send_json(200, body)
+
+    def do_GET(self) -> None:
+        self.handle_request("GET")
+
+    def do_POST(self) -> None:
+        self.handle_request("POST")
+
+    def do_DELETE(self) -> None:
+        self.handle_request("DELETE")
+
+
+def geocode_points() -> list[tuple[float, float]]:
+    ward_data = get_ward_data()
+    assert ward_data.grid
+    grid = ward_data.grid
+    rows, cols = np.nonzero(grid.cells > 0)
+    longs = grid.min_long + (cols + 0.5) * grid.cell_size
+    lats = grid.min_lat + (rows + 0.5) * grid.cell_size
+    return list(zip(longs.tolist(), lats.tolist()))
+
+
+def serve_mock_api(options: MockApiOptions, connection: Connection) -> None:
+    zipcodes = sorted(get_ward_data().wards_for_zip)
+    api = MockActionNetwork(options, [str(z) for z in zipcodes],
+                            geocode_points())
+    server = MockApiServer(api)
+    connection.send(server.server_address[1])
+    server.serve_forever()
+
+
+@dataclass
+class BenchReport:
+    num_members: int
+    workers: int
+    elapsed_secs: float
+    num_requests: int
+    num_geocode_requests: int
+    injected_errors: int
+    throttled_requests: int
+    latency_p50_ms: float
+    latency_p99_ms: float
+    peak_rss_mb: float
+    requests: dict[str, int] = field(default_factory=dict)
+    summary: Optional[TaggingsSummary] = None
+
+    def to_json(self) -> str:
+        assert self.summary
+        return json.dumps({
+            "members": self.num_members,
+            "workers": self.workers,
+            "elapsed secs": round(self.elapsed_secs, 3),
+            "members per sec": round(self.num_members / self.elapsed_secs,
+                                     1),
+            "requests": self.num_requests,
+            "requests per member": round(
+                self.num_requests / max(self.num_members, 1), 3),
+            "geocode requests": self.num_geocode_requests,
+            "injected errors": self.injected_errors,
+            "throttled requests": self.throttled_requests,
+            "latency p50 ms": round(self.latency_p50_ms, 2),
+            "latency p99 ms": round(self.latency_p99_ms, 2),
+            "peak rss mb": round(self.peak_rss_mb, 1),
+            "requests by endpoint": self.requests,
+            "summary": json.loads(self.summary.to_json()),
+        }, indent=2)
+
+
+# Runs the full tagging pipeline against a mock ActionNetwork API and
+# Nominatim server, running in a separate process so that it doesn't count
+# towards the pipeline's time or memory use. The pipeline uses an empty
+# cache directory, so every address is geocoded.
+def run_benchmark(options: MockApiOptions, workers: int = 1,
+                  prefetch_pages: int = 2, snapshot_taggings: bool = False,
+                  requests_per_second: Optional[float] = None,
+                  max_concurrency: Optional[int] = None,
+                  geocoder_requests_per_second: float = 1000.0,
+                  min_sqft: int = 12500) -> BenchReport:
+    # Make sure the compiled ward data is up to date before the server
+    # process (which also reads it) starts.
+    get_ward_data()
+    parent_connection, child_connection = multiprocessing.Pipe()
+    server_process = multiprocessing.Process(
+        target=serve_mock_api, args=(options, child_connection),
+        daemon=True)
+    server_process.start()
+    port = parent_connection.recv()
+    server_url = f"http://127.0.0.1:{port}"
+    logging.info("Mock API server listening at %s", server_url)
+
+    latencies: list[float] = []
+
+    def record_latency(rs: requests.Response, *args: Any,
+                       **kwargs: Any) -> None:
+        latencies.append(rs.elapsed.total_seconds())
+
+    try:
+        with tempfile.TemporaryDirectory() as state_dir:
+            client = Client("benchmark", pool_size=max(10, workers),
+                            requests_per_second=requests_per_second,
+                            max_concurrency=max_concurrency,
+                            base_url=server_url + API_PATH)
+            client.session.hooks["response"].append(record_latency)
+            cache = TaggerCache(Path(state_dir))
+            configure_geocoder(
+                NominatimBackend(server_url, geocoder_requests_per_second),
+                0, cache)
+
+            start_time = time.perf_counter()
+            summary = set_ward_tags_for_all_members_since(
+                client, min_sqft, workers=workers,
+                snapshot_taggings=snapshot_taggings,
+                prefetch_pages=prefetch_pages)
+            elapsed_secs = time.perf_counter() - start_time
+            summary.address_cache = cache.address_stats()
+            summary.metrics = get_metrics().snapshot()
+            summary.concurrency = client.concurrency_stats()
+            cache.close()
+        stats = requests.get(server_url + STATS_PATH, timeout=10).json()
+    finally:
+        server_process.terminate()
+        server_process.join()
+
+    request_counts: dict[str, int] = stats["requests"]
+    num_geocode_requests = request_counts.get(GEOCODE_ROUTE, 0)
+    latencies_ms = np.array(latencies or [0.0]) * 1000
+    # ru_maxrss is in kilobytes on Linux.
+    peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return BenchReport(
+        options.num_members, workers, elapsed_secs,
+        sum(request_counts.values()) - num_geocode_requests,
+        num_geocode_requests, stats["injected_errors"],
+        stats["throttled_requests"],
+        float(np.percentile(latencies_ms, 50)),
+        float(np.percentile(latencies_ms, 99)),
+        peak_rss_kb / 1024, request_counts, summary)
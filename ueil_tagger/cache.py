@@ -1,43 +1,156 @@
 from __future__ import annotations
 
+import atexit
+import functools
+from pathlib import Path
+import threading
+from types import TracebackType
 from typing import TYPE_CHECKING, Optional, cast
 
 from diskcache import Cache
 
 from ueil_tagger import STATE_DIR_PATH
+from ueil_tagger.addresses import normalize_address
+from ueil_tagger.metrics import timed_stage
+from ueil_tagger.types import CacheStats
 
 
 if TYPE_CHECKING:
-    from ueil_tagger.types import StreetAddress, LatLong, Uuid
+    from ueil_tagger.types import MemberFingerprint, StreetAddress, LatLong
+    from ueil_tagger.types import Uuid
 
 
 class TaggerCache:
     ADDRESS_CACHE_KEY = "addresses"
+    FAILED_ADDRESS_CACHE_KEY = "failed_addresses"
     BATCH_CACHE_KEY = "batch"
+    FINGERPRINT_CACHE_KEY = "fingerprints"
 
+    state_dir: Path
+    batch_cache_key: str
+    caches: dict[str, Cache]
+    lock: threading.Lock
+    address_hits: int
+    address_misses: int
+
+    def __init__(self, state_dir: Path = STATE_DIR_PATH) -> None:
+        self.state_dir = state_dir
+        self.batch_cache_key = self.BATCH_CACHE_KEY
+        self.caches = {}
+        self.lock = threading.Lock()
+        self.address_hits = 0
+        self.address_misses = 0
+
+    def __enter__(self) -> TaggerCache:
+        return self
+
+    def __exit__(self, exc_type: Optional[type[BaseException]],
+                 exc_value: Optional[BaseException],
+                 traceback: Optional[TracebackType]) -> None:
+        self.close()
+
+    def __cache(self, cache_key: str) -> Cache:
+        with self.lock:
+            if cache_key not in self.caches:
+                self.caches[cache_key] = Cache(self.state_dir / cache_key)
+            return self.caches[cache_key]
+
+    def close(self) -> None:
+        with self.lock:
+            for cache in self.caches.values():
+                cache.close()
+            self.caches = {}
+
+    @timed_stage("cache set address")
     def set_for_address(self, address: StreetAddress,
                         value: LatLong) -> None:
-        cache = Cache(STATE_DIR_PATH / self.ADDRESS_CACHE_KEY)
-        cache.set(address, value)
-        cache.close()
+        cache = self.__cache(self.ADDRESS_CACHE_KEY)
+        cache.set(normalize_address(address), value)
 
+    @timed_stage("cache get address")
     def get_for_address(self, address: StreetAddress) -> Optional[LatLong]:
-        cache = Cache(STATE_DIR_PATH / self.ADDRESS_CACHE_KEY)
-        if address in cache:
-            return cast("LatLong", cache[address])
-        return None
+        cache = self.__cache(self.ADDRESS_CACHE_KEY)
+        normalized_address = normalize_address(address)
+        value = cache.get(normalized_address)
+        # Entries written before addresses were normalized are keyed by the
+        # raw address, so check for those too, and re-key any we find.
+        if value is None and address != normalized_address:
+            value = cache.get(address)
+            if value is not None:
+                cache.set(normalized_address, value)
+        with self.lock:
+            if value is None:
+                self.address_misses += 1
+            else:
+                self.address_hits += 1
+        if value is None:
+            return None
+        return cast("LatLong", tuple(value))
+
+    @timed_stage("cache set failed address")
+    def set_failed_address(self, address: StreetAddress,
+                           ttl_secs: float) -> None:
+        cache = self.__cache(self.FAILED_ADDRESS_CACHE_KEY)
+        cache.set(normalize_address(address), True, expire=ttl_secs)
 
+    @timed_stage("cache check failed address")
+    def check_failed_address(self, address: StreetAddress) -> bool:
+        cache = self.__cache(self.FAILED_ADDRESS_CACHE_KEY)
+        if normalize_address(address) in cache:
+            return True
+        return False
+
+    def address_stats(self) -> CacheStats:
+        cache = self.__cache(self.ADDRESS_CACHE_KEY)
+        with self.lock:
+            return CacheStats(self.address_hits, self.address_misses,
+                              len(cache))
+
+    # Gives the batch cache its own namespace (e.g., for each shard), so that
+    # separate runs don't share batches.
+    def use_batch_namespace(self, namespace: str) -> None:
+        self.batch_cache_key = f"{self.BATCH_CACHE_KEY}-{namespace}"
+
+    @timed_stage("cache set batch")
     def set_member_uuid(self, member_uuid: Uuid) -> None:
-        cache = Cache(STATE_DIR_PATH / self.BATCH_CACHE_KEY)
+        cache = self.__cache(self.batch_cache_key)
         cache.set(member_uuid, True)
-        cache.close()
 
+    @timed_stage("cache set batch")
+    def set_member_uuids(self, member_uuids: list[Uuid]) -> None:
+        cache = self.__cache(self.batch_cache_key)
+        with cache.transact():
+            for member_uuid in member_uuids:
+                cache.set(member_uuid, True)
+
+    @timed_stage("cache check batch")
     def check_member_uuid(self, member_uuid: Uuid) -> bool:
-        cache = Cache(STATE_DIR_PATH / self.BATCH_CACHE_KEY)
+        cache = self.__cache(self.batch_cache_key)
         if member_uuid in cache:
             return True
         return False
 
     def clear_member_uuid_cache(self) -> None:
-        cache = Cache(STATE_DIR_PATH / self.BATCH_CACHE_KEY)
+        cache = self.__cache(self.batch_cache_key)
         cache.clear()
+
+    @timed_stage("cache set fingerprint")
+    def set_member_fingerprint(self, member_uuid: Uuid,
+                               fingerprint: MemberFingerprint) -> None:
+        cache = self.__cache(self.FINGERPRINT_CACHE_KEY)
+        cache.set(member_uuid, fingerprint)
+
+    @timed_stage("cache get fingerprint")
+    def get_member_fingerprint(
+            self, member_uuid: Uuid) -> Optional[MemberFingerprint]:
+        cache = self.__cache(self.FINGERPRINT_CACHE_KEY)
+        return cast("Optional[MemberFingerprint]", cache.get(member_uuid))
+
+
+# The cache shared by everything in the process, so that each cache
+# directory is only opened once per run.
+@functools.cache
+def get_tagger_cache() -> TaggerCache:
+    cache = TaggerCache()
+    atexit.register(cache.close)
+    return cache
@@ -3,27 +3,198 @@ from __future__ import annotations
 from datetime import datetime
 import json
 import logging
+import time
 from typing import Any, cast, Optional, TYPE_CHECKING
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+from urllib3.exceptions import TimeoutError
+from urllib3.response import BaseHTTPResponse
+from urllib3.util.retry import Retry
+
+from ueil_tagger.concurrency import ConcurrencyLimiter, RequestOutcome
+from ueil_tagger.metrics import get_metrics
+from ueil_tagger.ratelimit import RateLimiter
+from ueil_tagger.tracing import span, traced
+from ueil_tagger.types import ConcurrencyStats
 
 if TYPE_CHECKING:
     from ueil_tagger.types import Uuid, WebAPIRecord
 
 
-PEOPLE_ENDPOINT = "https://actionnetwork.org/api/v2/people"
-TAGS_ENDPOINT = "https://actionnetwork.org/api/v2/tags"
+API_BASE_URL = "https://actionnetwork.org/api/v2"
+
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+
+# Whether the API throttled a request, it timed out, or it failed,
+# including on any attempts that were retried.
+def request_outcome(rs: requests.Response) -> RequestOutcome:
+    retries = getattr(rs.raw, "retries", None)
+    history = retries.history if retries else ()
+    if rs.status_code == 429 or any(attempt.status == 429
+                                    for attempt in history):
+        return RequestOutcome.THROTTLED
+    # Like requests, treat a refused connection as an error, not a timeout.
+    if any(isinstance(attempt.error, TimeoutError) and
+           not isinstance(attempt.error, NewConnectionError)
+           for attempt in history):
+        return RequestOutcome.TIMED_OUT
+    if rs.status_code >= 500 or any(
+            attempt.error is not None or
+            (attempt.status is not None and attempt.status >= 500)
+            for attempt in history):
+        return RequestOutcome.ERROR
+    if history or not rs.ok:
+        return RequestOutcome.OTHER
+    return RequestOutcome.OK
+
+
+# Retries made by urllib3 also wait for the rate limiter, so that retrying
+# failed requests can't go over the rate limit.
+class RateLimitedRetry(Retry):
+    rate_limiter: Optional[RateLimiter] = None
+
+    def new(self, **kw: Any) -> RateLimitedRetry:
+        retry = super().new(**kw)
+        retry.rate_limiter = self.rate_limiter
+        return retry
+
+    def sleep(self, response: Optional[BaseHTTPResponse] = None) -> None:
+        super().sleep(response)
+        if self.rate_limiter:
+            with get_metrics().timed("rate limit wait"):
+                self.rate_limiter.acquire()
 
 
 class Client:
     api_key: str
     read_only: bool
+    people_endpoint: str
+    tags_endpoint: str
+    session: requests.Session
+    timeout: tuple[float, float]
+    rate_limiter: Optional[RateLimiter]
+    concurrency_limiter: Optional[ConcurrencyLimiter]
+    retry: RateLimitedRetry
 
-    def __init__(self, api_key: str, dry_run: bool = False) -> None:
+    def __init__(self, api_key: str, dry_run: bool = False,
+                 pool_size: int = 10, max_retries: int = 5,
+                 backoff_factor: float = 0.5, connect_timeout: float = 5,
+                 read_timeout: float = 10,
+                 requests_per_second: Optional[float] = None,
+                 base_url: str = API_BASE_URL,
+                 max_concurrency: Optional[int] = None) -> None:
         self.api_key = api_key
         self.read_only = dry_run
+        # A different base url can be given to use a stand-in for the
+        # ActionNetwork API (e.g., the mock server used by bench.py).
+        self.people_endpoint = f"{base_url.rstrip('/')}/people"
+        self.tags_endpoint = f"{base_url.rstrip('/')}/tags"
+        self.timeout = (connect_timeout, read_timeout)
+        self.rate_limiter = None
+        if requests_per_second:
+            self.rate_limiter = RateLimiter(requests_per_second)
+        # If given a maximum, the number of requests in flight at once is
+        # adjusted to what the API can handle, up to that maximum.
+        self.concurrency_limiter = None
+        if max_concurrency:
+            self.concurrency_limiter = ConcurrencyLimiter(max_concurrency)
+
+        # Tagging and untagging a person are both safe to repeat, so
+        # all three methods we use can be retried. When the concurrency
+        # limit is adjusted, 429 responses are retried by __request instead,
+        # so that throttled requests don't hold on to their place under the
+        # limit while they wait to be retried.
+        status_forcelist = RETRY_STATUS_CODES
+        if self.concurrency_limiter:
+            status_forcelist = [code for code in RETRY_STATUS_CODES
+                                if code != 429]
+        self.retry = RateLimitedRetry(
+            total=max_retries, backoff_factor=backoff_factor,
+            status_forcelist=status_forcelist,
+            allowed_methods=["GET", "POST", "DELETE"],
+            respect_retry_after_header=True, raise_on_status=False)
+        self.retry.rate_limiter = self.rate_limiter
+        adapter = HTTPAdapter(pool_maxsize=pool_size, max_retries=self.retry)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def __wait_for_rate_limit(self) -> None:
+        if self.rate_limiter:
+            with get_metrics().timed("rate limit wait"):
+                self.rate_limiter.acquire()
+
+    def concurrency_stats(self) -> ConcurrencyStats:
+        if not self.concurrency_limiter:
+            return ConcurrencyStats()
+        return self.concurrency_limiter.snapshot()
+
+    # Makes a request, once there's room for it under the concurrency and
+    # rate limits, and uses how it went to adjust the concurrency limit.
+    def __request(self, method: str, url: str, endpoint: str,
+                  **kwargs: Any) -> requests.Response:
+        if not self.concurrency_limiter:
+            self.__wait_for_rate_limit()
+            return self.__send(method, url, endpoint, **kwargs)
+
+        retry = self.retry
+        while True:
+            with get_metrics().timed("concurrency wait"):
+                started_at = self.concurrency_limiter.acquire()
+            outcome = RequestOutcome.OTHER
+            start_time = time.perf_counter()
+            try:
+                self.__wait_for_rate_limit()
+                start_time = time.perf_counter()
+                rs = self.__send(method, url, endpoint, **kwargs)
+                outcome = request_outcome(rs)
+            except requests.Timeout:
+                outcome = RequestOutcome.TIMED_OUT
+                raise
+            except requests.ConnectionError:
+                outcome = RequestOutcome.ERROR
+                raise
+            finally:
+                self.concurrency_limiter.release(
+                    started_at, outcome, time.perf_counter() - start_time)
+            if rs.status_code != 429:
+                return rs
+            try:
+                retry = retry.increment(method, url, response=rs.raw)
+            except MaxRetryError:
+                return rs
+            logging.debug("...throttled, retrying %s %s", method, url)
+            # Only back off here, since the retry waits for the rate limit
+            # once it has a place under the concurrency limit.
+            Retry.sleep(retry, rs.raw)
 
-    def __delete(self, url: str, background: bool = True) -> bool:
+    # Sends a request, recording its time, size and number of retries under
+    # a stage named for the request method and endpoint.
+    def __send(self, method: str, url: str, endpoint: str,
+               **kwargs: Any) -> requests.Response:
+        stage = f"http {method} {endpoint}"
+        start_time = time.perf_counter()
+        try:
+            with span(stage):
+                rs = self.session.request(method, url, timeout=self.timeout,
+                                          **kwargs)
+        except requests.RequestException:
+            get_metrics().observe(stage, time.perf_counter() - start_time,
+                                  error=True)
+            raise
+        retries = getattr(rs.raw, "retries", None)
+        request_body = rs.request.body or b""
+        get_metrics().observe(
+            stage, time.perf_counter() - start_time,
+            len(rs.content) + len(request_body),
+            len(retries.history) if retries else 0, not rs.ok)
+        return rs
+
+    def __delete(self, url: str, endpoint: str,
+                 background: bool = True) -> bool:
         headers = {
             "api-key": self.api_key
         }
@@ -33,11 +204,15 @@ class Client:
         logging.debug("(DELETE) %s params=(%s)", url, json.dumps(params))
         if self.read_only:
             return True
-        rs = requests.delete(url, headers=headers, params=params, timeout=10)
+        rs = self.__request("DELETE", url, endpoint, headers=headers,
+                            params=params)
         logging.debug("...%s: %s bytes", rs.status_code, len(rs.content))
+        if not rs.ok:
+            logging.error("Unexpected response from the server:\n%s",
+                          rs.text)
         return rs.ok
 
-    def __post(self, url: str, data: Optional[Any],
+    def __post(self, url: str, endpoint: str, data: Optional[Any],
                background: bool = True) -> bool:
         headers = {
             "Content-Type": "application/json",
@@ -50,15 +225,16 @@ class Client:
                       url, json.dumps(params), json.dumps(data))
         if self.read_only:
             return True
-        rs = requests.post(url, json=data, headers=headers, params=params,
-                           timeout=10)
+        rs = self.__request("POST", url, endpoint, json=data,
+                            headers=headers, params=params)
         logging.debug("...%s: %s bytes", rs.status_code, len(rs.content))
         if not rs.ok:
             logging.error("Unexpected response from the server:\n%s",
                           rs.text)
         return rs.ok
 
-    def __get(self, url: str,
+    @traced("Client.__get")
+    def __get(self, url: str, endpoint: str,
               params: Optional[dict[str, str]] = None) -> WebAPIRecord:
         if not params:
             params = {}
@@ -67,15 +243,20 @@ class Client:
             "OSDI-API-Token": self.api_key
         }
         logging.debug("(GET) %s params=(%s)", url, json.dumps(params))
-        rs = requests.get(url, params=params, headers=headers, timeout=10)
+        rs = self.__request("GET", url, endpoint, params=params,
+                            headers=headers)
         logging.debug("...%s: %s bytes", rs.status_code, len(rs.content))
+        if not rs.ok:
+            logging.error("Unexpected response from the server:\n%s",
+                          rs.text)
+            rs.raise_for_status()
         return cast("WebAPIRecord", rs.json())
 
     def get_tags(self, page: int = 1) -> WebAPIRecord:
         params = {
             "page": str(page)
         }
-        return self.__get(TAGS_ENDPOINT, params)
+        return self.__get(self.tags_endpoint, "tags", params)
 
     def get_people(self, page: int = 1,
                    modified_since: Optional[datetime] = None) -> WebAPIRecord:
@@ -85,16 +266,16 @@ class Client:
         if modified_since is not None:
             date_filter = f"modified_date gt '{modified_since.isoformat()}'"
             params["filter"] = date_filter
-        return self.__get(PEOPLE_ENDPOINT, params)
+        return self.__get(self.people_endpoint, "people", params)
 
     def get_person(self, person_uuid: Uuid) -> WebAPIRecord:
-        url = f"{PEOPLE_ENDPOINT}/{person_uuid}"
-        return self.__get(url, {})
+        url = f"{self.people_endpoint}/{person_uuid}"
+        return self.__get(url, "person", {})
 
     def set_tagging_for_person(self, tag_uuid: Uuid, person_uuid: Uuid,
                                background: bool = True) -> bool:
-        person_url = f"{PEOPLE_ENDPOINT}/{person_uuid}"
-        url = f"{TAGS_ENDPOINT}/{tag_uuid}/taggings"
+        person_url = f"{self.people_endpoint}/{person_uuid}"
+        url = f"{self.tags_endpoint}/{tag_uuid}/taggings"
         data = {
             "_links": {
                 "osdi:person": {
@@ -102,23 +283,35 @@ class Client:
                 }
             }
         }
-        return self.__post(url, data, background=background)
+        return self.__post(url, "tagging", data, background=background)
 
-    def get_taggings_for_person(self, person_uuid: Uuid,
-                                page: int = 1) -> list[Uuid]:
-        url = f"{PEOPLE_ENDPOINT}/{person_uuid}/taggings"
+    def get_taggings_for_person(self, person_uuid: Uuid) -> list[Uuid]:
+        url = f"{self.people_endpoint}/{person_uuid}/taggings"
+        tag_uuids = []
+        page_index = 1
+        while True:
+            params = {
+                "page": str(page_index)
+            }
+            results = self.__get(url, "person taggings", params)
+            for tag in results["_embedded"]["osdi:taggings"]:
+                tag_href = tag["_links"]["osdi:tag"]["href"]
+                tag_uuid = tag_href.split("/")[-1]
+                tag_uuids.append(tag_uuid)
+            if page_index >= results.get("total_pages", 1):
+                break
+            page_index += 1
+        return tag_uuids
+
+    def get_taggings_for_tag(self, tag_uuid: Uuid,
+                             page: int = 1) -> WebAPIRecord:
+        url = f"{self.tags_endpoint}/{tag_uuid}/taggings"
         params = {
             "page": str(page)
         }
-        results = self.__get(url, params)
-        tag_uuids = []
-        for tag in results["_embedded"]["osdi:taggings"]:
-            tag_href = tag["_links"]["osdi:tag"]["href"]
-            tag_uuid = tag_href.split("/")[-1]
-            tag_uuids.append(tag_uuid)
-        return tag_uuids
+        return self.__get(url, "tag taggings", params)
 
     def delete_tagging_for_person(self, tag_uuid: Uuid, person_uuid: Uuid,
                                   background: bool = True) -> bool:
-        url = f"{TAGS_ENDPOINT}/{tag_uuid}/taggings/{person_uuid}"
-        return self.__delete(url, background=background)
+        url = f"{self.tags_endpoint}/{tag_uuid}/taggings/{person_uuid}"
+        return self.__delete(url, "tagging", background=background)
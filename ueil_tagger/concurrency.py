@@ -0,0 +1,194 @@
+from __future__ import annotations
+
+from dataclasses import replace
+from enum import Enum
+import logging
+import threading
+import time
+from typing import Optional
+
+import numpy as np
+
+from ueil_tagger.types import ConcurrencyStats
+
+
+# The limit the adaptive limiter starts at, before it has seen how the API
+# responds.
+INITIAL_CONCURRENCY = 4
+# How much the limit is multiplied by when the API is overloaded.
+BACKOFF_RATIO = 0.5
+# How many windows of healthy requests it takes to raise the limit back to
+# (or beyond) the limit the API last throttled at.
+PROBE_WINDOWS = 5
+# How many times higher than usual the p95 latency of a window of requests
+# can be before the API is treated as overloaded.
+LATENCY_TOLERANCE = 2.0
+# The fewest requests whose latencies are compared at once.
+MIN_WINDOW_SIZE = 10
+# The largest share of a window of requests that can fail (with a 5xx
+# response or a connection error) before the API is treated as overloaded.
+MAX_ERROR_RATE = 0.1
+# How far the usual p95 latency moves towards each window's p95 latency
+# (so that a slower API eventually becomes the new usual).
+BASELINE_DRIFT = 0.1
+
+
+class RequestOutcome(Enum):
+    OK = "ok"
+    # A 429 response (even if the request was then retried).
+    THROTTLED = "throttled"
+    # A timeout (even if the request was then retried).
+    TIMED_OUT = "timed out"
+    # A 5xx response or a connection error (even if the request was then
+    # retried).
+    ERROR = "error"
+    # Anything else (e.g., a 404 response), which says nothing about how
+    # loaded the API is.
+    OTHER = "other"
+
+
+# Limits how many requests are in flight at once, and adjusts the limit
+# using AIMD: the limit goes up by one after each window of healthy
+# requests, and is cut by BACKOFF_RATIO after a 429 response, a timeout,
+# or a window with too many errors or whose p95 latency is well above the
+# usual. Like RateLimiter,
+# it's meant to be shared between every thread making requests.
+class ConcurrencyLimiter:
+    min_limit: int
+    max_limit: int
+    limit: int
+    in_flight: int
+    condition: threading.Condition
+    # The latencies of the successful requests, and the number of failed
+    # requests, in the current window.
+    latencies: list[float]
+    num_errors: int
+    # The most requests in flight at once during the current window.
+    peak_in_flight: int
+    baseline_p95: Optional[float]
+    # The limit at which the API last pushed back, and how many healthy
+    # windows there have been since the limit was last raised.
+    overloaded_limit: Optional[int]
+    healthy_windows: int
+    # Requests started before the limit was last cut were made under the
+    # old limit, so don't cut it again.
+    last_decrease_time: float
+    stats: ConcurrencyStats
+
+    def __init__(self, max_limit: int, min_limit: int = 1,
+                 initial_limit: int = INITIAL_CONCURRENCY) -> None:
+        if max_limit < min_limit or min_limit < 1:
+            raise ValueError(f"Invalid concurrency limits, {min_limit} to "
+                             f"{max_limit}")
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = max(min_limit, min(initial_limit, max_limit))
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.latencies = []
+        self.num_errors = 0
+        self.peak_in_flight = 0
+        self.baseline_p95 = None
+        self.overloaded_limit = None
+        self.healthy_windows = 0
+        self.last_decrease_time = time.monotonic()
+        self.stats = ConcurrencyStats(self.limit, self.limit, self.limit)
+
+    # Waits until there's room for another request, and returns when it
+    # started (to be given to release).
+    def acquire(self) -> float:
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            return time.monotonic()
+
+    def release(self, started_at: float, outcome: RequestOutcome,
+                latency_secs: float) -> None:
+        with self.condition:
+            self.in_flight -= 1
+            if outcome in (RequestOutcome.THROTTLED,
+                           RequestOutcome.TIMED_OUT):
+                self.__decrease(started_at, outcome.value)
+            elif outcome in (RequestOutcome.OK, RequestOutcome.ERROR):
+                self.__observe(started_at, outcome, latency_secs)
+            self.condition.notify_all()
+
+    def __observe(self, started_at: float, outcome: RequestOutcome,
+                  latency_secs: float) -> None:
+        if outcome == RequestOutcome.ERROR:
+            self.num_errors += 1
+        else:
+            self.latencies.append(latency_secs)
+        window_size = len(self.latencies) + self.num_errors
+        if window_size < max(self.limit, MIN_WINDOW_SIZE):
+            return
+        error_rate = self.num_errors / window_size
+        latencies = self.latencies
+        peak_in_flight = self.peak_in_flight
+        self.latencies = []
+        self.num_errors = 0
+        self.peak_in_flight = self.in_flight
+        if error_rate > MAX_ERROR_RATE or not latencies:
+            self.__decrease(started_at, "errors")
+            return
+        p95 = float(np.percentile(latencies, 95))
+        baseline_p95 = self.baseline_p95
+        if baseline_p95 is None or p95 < baseline_p95:
+            self.baseline_p95 = p95
+        else:
+            self.baseline_p95 = baseline_p95 + (
+                (p95 - baseline_p95) * BASELINE_DRIFT)
+        if (baseline_p95 is not None and
+                p95 > baseline_p95 * LATENCY_TOLERANCE):
+            self.__decrease(started_at, "latency")
+            return
+        # Only raise the limit if it's being reached, and raise it more
+        # slowly once it's close to where the API last pushed back.
+        self.healthy_windows += 1
+        probe_windows = 1
+        if (self.overloaded_limit is not None and
+                self.limit + 1 >= self.overloaded_limit):
+            probe_windows = PROBE_WINDOWS
+        if (peak_in_flight >= self.limit and
+                self.limit < self.max_limit and
+                self.healthy_windows >= probe_windows):
+            self.limit += 1
+            self.healthy_windows = 0
+            self.stats.increases += 1
+            self.stats.max_limit = max(self.stats.max_limit, self.limit)
+            if (self.overloaded_limit is not None and
+                    self.limit > self.overloaded_limit):
+                self.overloaded_limit = None
+            logging.debug("Raised request concurrency limit to %s (p95 "
+                          "latency %.3fs)", self.limit, p95)
+        self.stats.limit = self.limit
+
+    def __decrease(self, started_at: float, reason: str) -> None:
+        if started_at < self.last_decrease_time:
+            return
+        if reason == "latency":
+            self.stats.latency_events += 1
+        elif reason == "errors":
+            self.stats.error_events += 1
+        else:
+            self.stats.throttle_events += 1
+        self.last_decrease_time = time.monotonic()
+        self.latencies = []
+        self.num_errors = 0
+        self.peak_in_flight = self.in_flight
+        self.healthy_windows = 0
+        self.overloaded_limit = self.limit
+        new_limit = max(self.min_limit, int(self.limit * BACKOFF_RATIO))
+        if new_limit == self.limit:
+            return
+        self.limit = new_limit
+        self.stats.limit = self.limit
+        self.stats.min_limit = min(self.stats.min_limit, self.limit)
+        logging.info("Lowered request concurrency limit to %s (%s)",
+                     self.limit, reason)
+
+    def snapshot(self) -> ConcurrencyStats:
+        with self.condition:
+            return replace(self.stats)
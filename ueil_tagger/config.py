@@ -3,6 +3,7 @@ from __future__ import annotations
 import functools
 from datetime import datetime
 import logging
+from pathlib import Path
 import tomllib
 from typing import cast, Optional, TYPE_CHECKING
 
@@ -33,6 +34,76 @@ def get_min_zip_sqft() -> float:
     return cast(float, config["min-zip-sqft"])
 
 
+def get_http_pool_size() -> int:
+    config = get_config()
+    return int(config.get("http-pool-size", 10))
+
+
+def get_http_max_retries() -> int:
+    config = get_config()
+    return int(config.get("http-max-retries", 5))
+
+
+def get_http_backoff_factor() -> float:
+    config = get_config()
+    return float(config.get("http-backoff-factor", 0.5))
+
+
+def get_http_connect_timeout() -> float:
+    config = get_config()
+    return float(config.get("http-connect-timeout", 5))
+
+
+def get_http_read_timeout() -> float:
+    config = get_config()
+    return float(config.get("http-read-timeout", 10))
+
+
+def get_http_max_concurrency() -> int:
+    config = get_config()
+    return int(config.get("http-max-concurrency", 0))
+
+
+def get_max_requests_per_second() -> float:
+    config = get_config()
+    return float(config.get("max-requests-per-second", 4))
+
+
+def get_serve_secret() -> Optional[str]:
+    config = get_config()
+    secret = config.get("serve-secret")
+    return str(secret) if secret else None
+
+
+def get_geocoder_url() -> Optional[str]:
+    config = get_config()
+    url = config.get("geocoder-url")
+    return str(url) if url else None
+
+
+def get_geocoder_requests_per_second() -> float:
+    config = get_config()
+    return float(config.get("geocoder-requests-per-second", 1))
+
+
+def get_geocoder_timeout() -> float:
+    config = get_config()
+    return float(config.get("geocoder-timeout", 30))
+
+
+def get_failed_address_ttl_days() -> float:
+    config = get_config()
+    return float(config.get("failed-address-ttl-days", 30))
+
+
+def get_local_address_points_path() -> Optional[Path]:
+    config = get_config()
+    path_text = config.get("local-address-points")
+    if not path_text:
+        return None
+    return ROOT_DIR_PATH / str(path_text)
+
+
 def get_last_run() -> Optional[datetime]:
     last_run_path = STATE_DIR_PATH / "last_run.txt"
     if not last_run_path.is_file():
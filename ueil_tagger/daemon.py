@@ -0,0 +1,350 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+import hmac
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import ipaddress
+import json
+import logging
+import signal
+import threading
+import time
+from typing import Any, Optional, TYPE_CHECKING
+from urllib.parse import parse_qs, urlsplit
+
+from ueil_tagger.members import get_member_from_record
+from ueil_tagger.members import set_ward_tags_for_member
+from ueil_tagger.members import uuid_for_member_record
+from ueil_tagger.types import TaggingsSummary
+from ueil_tagger.wards import get_ward_id_to_uuid_map, get_ward_index
+from ueil_tagger.wards import significant_wards_for_zip
+
+if TYPE_CHECKING:
+    from ueil_tagger.client import Client
+    from ueil_tagger.types import Uuid, WardToTagMap, WebAPIRecord
+
+
+# How long to wait for more changes to a person before updating them, since
+# one sign-up often triggers several webhooks.
+DEBOUNCE_SECS = 5.0
+# How often the ward tags are looked up again, in case they've changed.
+TAG_MAP_REFRESH_SECS = 60 * 60
+MAX_REQUEST_BYTES = 1024 * 1024
+
+
+@dataclass
+class QueuedPerson:
+    # The person's record, if it was sent to us (otherwise it's requested
+    # when the person is updated).
+    record: Optional[WebAPIRecord]
+    due_time: float
+
+
+# People waiting to be updated, each updated once no more changes to them
+# have arrived for delay seconds. A person is never handed to more than
+# one worker at a time.
+class DebouncedQueue:
+    delay: float
+    condition: threading.Condition
+    pending: dict[Uuid, QueuedPerson]
+    in_progress: set[Uuid]
+    closed: bool
+
+    def __init__(self, delay: float = DEBOUNCE_SECS) -> None:
+        self.delay = delay
+        self.condition = threading.Condition()
+        self.pending = {}
+        self.in_progress = set()
+        self.closed = False
+
+    def __len__(self) -> int:
+        with self.condition:
+            return len(self.pending) + len(self.in_progress)
+
+    # Queuing a person without their record (e.g., from a webhook, which
+    # means they've changed) drops any record already queued for them, so
+    # that they're requested again when they're updated.
+    def put(self, person_uuid: Uuid,
+            record: Optional[WebAPIRecord] = None) -> None:
+        with self.condition:
+            due_time = time.monotonic() + self.delay
+            self.pending[person_uuid] = QueuedPerson(record, due_time)
+            self.condition.notify_all()
+
+    # Waits for the next person that is due to be updated, and returns
+    # None once the queue is closed and empty. Once closed, people are
+    # returned without waiting for them to be due.
+    def get(self) -> Optional[tuple[Uuid, Optional[WebAPIRecord]]]:
+        with self.condition:
+            while True:
+                waiting = [(queued.due_time, person_uuid)
+                           for person_uuid, queued in self.pending.items()
+                           if person_uuid not in self.in_progress]
+                if not waiting and self.closed and not self.in_progress:
+                    return None
+                now = time.monotonic()
+                timeout = None
+                if waiting:
+                    due_time, person_uuid = min(waiting)
+                    if self.closed or due_time <= now:
+                        self.in_progress.add(person_uuid)
+                        queued = self.pending.pop(person_uuid)
+                        return person_uuid, queued.record
+                    timeout = due_time - now
+                self.condition.wait(timeout)
+
+    def done(self, person_uuid: Uuid) -> None:
+        with self.condition:
+            self.in_progress.discard(person_uuid)
+            self.condition.notify_all()
+
+    def close(self) -> None:
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+def person_uuids_from_webhook(payload: Any) -> list[Uuid]:
+    # ActionNetwork webhooks are lists of objects like
+    # {"osdi:submission": {..., "_links": {"osdi:person": {"href": ...}}}}.
+    person_uuids = []
+    for item in payload if isinstance(payload, list) else [payload]:
+        if not isinstance(item, dict):
+            continue
+        for value in item.values():
+            if not isinstance(value, dict):
+                continue
+            links = value.get("_links", {})
+            person_href = links.get("osdi:person", {}).get("href")
+            if person_href:
+                person_uuids.append(person_href.rstrip("/").split("/")[-1])
+                continue
+            person_uuid = uuid_for_member_record(value.get("person", {}))
+            if person_uuid:
+                person_uuids.append(person_uuid)
+    return person_uuids
+
+
+# Keeps everything needed to update a member (the ward index, zipcode
+# table, ward tags and the client's connections) loaded between updates.
+class TaggingService:
+    client: Client
+    min_sqft: int
+    incremental: bool
+    queue: DebouncedQueue
+    summary: TaggingsSummary
+    lock: threading.Lock
+    ward_to_tag_map: WardToTagMap
+    tag_map_time: Optional[float]
+    threads: list[threading.Thread]
+
+    def __init__(self, client: Client, min_sqft: int,
+                 debounce_secs: float = DEBOUNCE_SECS,
+                 incremental: bool = False) -> None:
+        self.client = client
+        self.min_sqft = min_sqft
+        self.incremental = incremental
+        self.queue = DebouncedQueue(debounce_secs)
+        self.summary = TaggingsSummary()
+        self.lock = threading.Lock()
+        self.ward_to_tag_map = {}
+        self.tag_map_time = None
+        self.threads = []
+
+    def __tag_map(self) -> WardToTagMap:
+        with self.lock:
+            if (self.tag_map_time is None or time.monotonic() -
+                    self.tag_map_time > TAG_MAP_REFRESH_SECS):
+                logging.info("Loading ward tags")
+                self.ward_to_tag_map = get_ward_id_to_uuid_map(self.client)
+                self.tag_map_time = time.monotonic()
+            return self.ward_to_tag_map
+
+    def warm(self) -> None:
+        get_ward_index()
+        significant_wards_for_zip(self.min_sqft)
+        self.__tag_map()
+
+    def submit_person(self, record: WebAPIRecord) -> Optional[Uuid]:
+        person_uuid = uuid_for_member_record(record)
+        if person_uuid:
+            self.queue.put(person_uuid, record)
+        return person_uuid
+
+    def submit_uuid(self, person_uuid: Uuid) -> None:
+        self.queue.put(person_uuid)
+
+    def __update(self, person_uuid: Uuid,
+                 record: Optional[WebAPIRecord]) -> None:
+        if record is None:
+            record = self.client.get_person(person_uuid)
+        member = get_member_from_record(record)
+        if not member:
+            logging.info("person=%s: no address or ward to tag from",
+                         person_uuid)
+            return
+        member_summary = set_ward_tags_for_member(
+            self.client, member, self.min_sqft, self.__tag_map(),
+            incremental=self.incremental)
+        with self.lock:
+            self.summary.merge(member_summary)
+
+    def __work(self) -> None:
+        while True:
+            next_person = self.queue.get()
+            if not next_person:
+                return
+            person_uuid, record = next_person
+            try:
+                self.__update(person_uuid, record)
+            except Exception:
+                logging.exception("person=%s: unable to update", person_uuid)
+                with self.lock:
+                    self.summary.error_count += 1
+            finally:
+                self.queue.done(person_uuid)
+
+    def start(self, workers: int = 1) -> None:
+        for _ in range(workers):
+            thread = threading.Thread(target=self.__work, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    # Updates everyone still waiting in the queue, and then stops.
+    def stop(self) -> None:
+        self.queue.close()
+        for thread in self.threads:
+            thread.join()
+
+    def status(self) -> dict[str, Any]:
+        with self.lock:
+            summary = json.loads(self.summary.to_json())
+        return {"queued": len(self.queue), "summary": summary}
+
+
+def is_loopback_host(host: str) -> bool:
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+class TaggingServer(ThreadingHTTPServer):
+    daemon_threads = True
+    service: TaggingService
+    # If set, the secret that every POST has to include.
+    secret: Optional[str]
+
+    def __init__(self, address: tuple[str, int], service: TaggingService,
+                 secret: Optional[str] = None) -> None:
+        super().__init__(address, TaggingRequestHandler)
+        self.service = service
+        self.secret = secret
+
+    def is_loopback(self) -> bool:
+        return is_loopback_host(str(self.server_address[0]))
+
+
+class TaggingRequestHandler(BaseHTTPRequestHandler):
+    server: TaggingServer
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logging.debug("%s - %s", self.address_string(), format % args)
+
+    def send_json(self, status: int, body: Any) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def has_secret(self) -> bool:
+        secret = self.server.secret
+        if not secret:
+            return False
+        given = ""
+        authorization = self.headers.get("Authorization", "")
+        if authorization.startswith("Bearer "):
+            given = authorization.removeprefix("Bearer ")
+        else:
+            query = parse_qs(urlsplit(self.path).query)
+            given = query.get("secret", [""])[0]
+        return hmac.compare_digest(given.encode(), secret.encode())
+
+    def do_GET(self) -> None:
+        if urlsplit(self.path).path.rstrip("/") != "/status":
+            self.send_json(404, {"error": "Unknown endpoint"})
+            return
+        self.send_json(200, self.server.service.status())
+
+    # POST /people takes a person record (or a list of them), like those
+    # returned by the ActionNetwork API. POST /webhook takes ActionNetwork
+    # webhook payloads, and the people they mention are requested from the
+    # API when they're updated. Since person records are trusted as they
+    # are, they're only taken with the secret, or (if there's no secret)
+    # when serving on a loopback address.
+    def do_POST(self) -> None:
+        path = urlsplit(self.path).path.rstrip("/")
+        if path not in ("/people", "/webhook"):
+            self.send_json(404, {"error": "Unknown endpoint"})
+            return
+        if self.server.secret and not self.has_secret():
+            self.send_json(401, {"error": "Missing or incorrect secret"})
+            return
+        if (path == "/people" and not self.server.secret and
+                not self.server.is_loopback()):
+            self.send_json(403, {"error": "Person records are only taken "
+                                          "with a secret (see "
+                                          "'serve-secret')"})
+            return
+        content_length = int(self.headers.get("Content-Length", 0))
+        if content_length > MAX_REQUEST_BYTES:
+            self.send_json(413, {"error": "Request too large"})
+            return
+        try:
+            payload = json.loads(self.rfile.read(content_length))
+        except ValueError:
+            self.send_json(400, {"error": "Invalid JSON"})
+            return
+
+        service = self.server.service
+        queued = []
+        if path == "/people":
+            records = payload if isinstance(payload, list) else [payload]
+            for record in records:
+                if isinstance(record, dict):
+                    person_uuid = service.submit_person(record)
+                    if person_uuid:
+                        queued.append(person_uuid)
+        else:
+            for person_uuid in person_uuids_from_webhook(payload):
+                service.submit_uuid(person_uuid)
+                queued.append(person_uuid)
+        logging.info("Queued %s people from %s", len(queued), path)
+        self.send_json(202, {"queued": queued})
+
+
+# Serves until interrupted (or sent SIGTERM), and then finishes updating
+# everyone already queued.
+def serve(service: TaggingService, host: str, port: int,
+          workers: int = 1, secret: Optional[str] = None) -> None:
+    if not secret and not is_loopback_host(host):
+        logging.warning("No serve-secret is set, so only webhooks will be "
+                        "taken on %s:%s, not person records", host, port)
+    logging.info("Loading ward data and tags")
+    service.warm()
+    service.start(workers)
+    server = TaggingServer((host, port), service, secret)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    logging.info("Listening for people to update on %s:%s", host, port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("Stopping, after updating %s queued people",
+                     len(service.queue))
+    finally:
+        server.server_close()
+        service.stop()
@@ -1,31 +1,159 @@
+from __future__ import annotations
+
+from concurrent.futures import Future
+import functools
 import logging
-from typing import Optional
+import threading
+from typing import Optional, Protocol, TYPE_CHECKING
 
 from geopy.geocoders import Nominatim
 
 import ueil_tagger
-from ueil_tagger.cache import TaggerCache
+from ueil_tagger.addresses import normalize_address
+from ueil_tagger.cache import get_tagger_cache, TaggerCache
+from ueil_tagger.metrics import timed_stage
+from ueil_tagger.ratelimit import RateLimiter
 from ueil_tagger.types import Coords
 
+if TYPE_CHECKING:
+    from ueil_tagger.types import StreetAddress
+
+
+NOMINATIM_DOMAIN = "nominatim.openstreetmap.org"
+# Nominatim's usage policy allows at most one request per second.
+NOMINATIM_REQUESTS_PER_SECOND = 1.0
+NOMINATIM_TIMEOUT = 30.0
+# How long to remember that an address couldn't be geocoded, before trying
+# to geocode it again.
+FAILED_ADDRESS_TTL_SECS = 30 * 24 * 60 * 60
+
+
+class GeocoderBackend(Protocol):
+    def geocode(self, address: StreetAddress) -> Optional[Coords]:
+        ...
+
+
+class NominatimBackend:
+    geolocator: Nominatim
+    rate_limiter: RateLimiter
+    timeout: float
+
+    def __init__(self, url: Optional[str] = None,
+                 requests_per_second: float = NOMINATIM_REQUESTS_PER_SECOND,
+                 timeout: float = NOMINATIM_TIMEOUT) -> None:
+        # A url can be given to use a different Nominatim compatible
+        # server, like a locally hosted instance.
+        domain = NOMINATIM_DOMAIN
+        scheme = "https"
+        if url:
+            scheme, _, domain = url.rstrip("/").partition("://")
+        self.geolocator = Nominatim(user_agent=ueil_tagger.APP_NAME,
+                                    domain=domain, scheme=scheme)
+        self.rate_limiter = RateLimiter(requests_per_second, burst=1)
+        self.timeout = timeout
+
+    def geocode(self, address: StreetAddress) -> Optional[Coords]:
+        self.rate_limiter.acquire()
+        location = self.geolocator.geocode(address, timeout=self.timeout)
+        if not location:
+            return None
+        return Coords(location.latitude, location.longitude)
+
+
+class Geocoder:
+    backend: GeocoderBackend
+    cache: TaggerCache
+    failed_address_ttl: float
+    lock: threading.Lock
+    in_flight: dict[StreetAddress, Future[Optional[Coords]]]
+
+    def __init__(self, backend: GeocoderBackend, cache: TaggerCache,
+                 failed_address_ttl: float = FAILED_ADDRESS_TTL_SECS) -> None:
+        self.backend = backend
+        self.cache = cache
+        self.failed_address_ttl = failed_address_ttl
+        self.lock = threading.Lock()
+        self.in_flight = {}
+
+    # Looks an address up in the cache only, and returns whether it was
+    # found, along with its coords (which are None if it previously failed
+    # to geocode).
+    def cached_coords_for_address(
+            self, address: StreetAddress) -> tuple[bool, Optional[Coords]]:
+        cache_result = self.cache.get_for_address(address)
+        if cache_result:
+            cached_coords = Coords(*cache_result)
+            logging.debug(" * Geocode cache '%s' to (lat=%s, long=%s)",
+                          address, cached_coords.lat, cached_coords.long)
+            return True, cached_coords
+        if self.cache.check_failed_address(address):
+            logging.debug(" * Geocode cache '%s' as previously failed",
+                          address)
+            return True, None
+        return False, None
+
+    @timed_stage("geocode")
+    def coords_for_address(self, address: StreetAddress) -> Optional[Coords]:
+        logging.debug(" - About to geocode '%s'", address)
+        found, cached_coords = self.cached_coords_for_address(address)
+        if found:
+            return cached_coords
+
+        # If another thread is already geocoding the same address, wait for
+        # its result instead of making a second request.
+        address_key = normalize_address(address)
+        with self.lock:
+            pending = self.in_flight.get(address_key)
+            if pending is None:
+                future: Future[Optional[Coords]] = Future()
+                self.in_flight[address_key] = future
+        if pending is not None:
+            logging.debug(" * Waiting on in-progress geocode of '%s'",
+                          address)
+            return pending.result()
+
+        try:
+            coords = self.__geocode(address)
+            future.set_result(coords)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[address_key]
+        return coords
+
+    @timed_stage("geocode request")
+    def __geocode(self, address: StreetAddress) -> Optional[Coords]:
+        coords = self.backend.geocode(address)
+        if not coords:
+            logging.error(" ! Unable to geocode '%s'", address)
+            self.cache.set_failed_address(address, self.failed_address_ttl)
+            return None
+        logging.debug(" * Successfully geocoded '%s' to (lat=%s, long=%s)",
+                      address, coords.lat, coords.long)
+        self.cache.set_for_address(address, (coords.lat, coords.long))
+        return coords
+
+
+@functools.cache
+def get_geocoder() -> Geocoder:
+    return Geocoder(NominatimBackend(), get_tagger_cache())
+
+
+def configure_geocoder(backend: GeocoderBackend,
+                       failed_address_ttl: float,
+                       cache: Optional[TaggerCache] = None) -> None:
+    geocoder = get_geocoder()
+    geocoder.backend = backend
+    geocoder.failed_address_ttl = failed_address_ttl
+    if cache:
+        geocoder.cache = cache
+
 
 def coords_for_address(address: str) -> Optional[Coords]:
-    logging.debug(" - About to geocode '%s'", address)
-    cache = TaggerCache()
-    cache_result = cache.get_for_address(address)
-    if cache_result:
-        cached_coords = Coords(*cache_result)
-        logging.debug(" * Geocode cache '%s' to (lat=%s, long=%s)",
-                      address, cached_coords.lat, cached_coords.long)
-        return cached_coords
-
-    geolocator = Nominatim(user_agent=ueil_tagger.APP_NAME)
-    location = geolocator.geocode(address, timeout=30)
-    if not location:
-        logging.error(" ! Unable to geocode '%s'", address)
-        return None
-    logging.debug(" * Successfully geocoded '%s' to (lat=%s, long=%s)",
-                  address, location.latitude, location.longitude)
-    coords = Coords(location.latitude, location.longitude)
-
-    cache.set_for_address(address, (coords.lat, coords.long))
-    return coords
+    return get_geocoder().coords_for_address(address)
+
+
+def cached_coords_for_address(address: str) -> tuple[bool, Optional[Coords]]:
+    return get_geocoder().cached_coords_for_address(address)
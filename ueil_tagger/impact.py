@@ -0,0 +1,151 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+import logging
+from pathlib import Path
+from typing import Optional, TYPE_CHECKING
+
+import numpy as np
+import shapely
+from shapely import STRtree
+
+from ueil_tagger.cache import TaggerCache
+from ueil_tagger.types import NO_WARD
+from ueil_tagger.ward_data import parse_source_ward_data, WardData
+from ueil_tagger.ward_data import ZIPCODE_SOURCE_PATH
+from ueil_tagger.wards import address_to_geocode, significant_wards
+from ueil_tagger.wards import WardIndex, WardShape
+
+if TYPE_CHECKING:
+    from shapely.geometry.base import BaseGeometry
+    from ueil_tagger.types import Member, Uuid, WardNum, ZipCode
+
+
+# The members whose wards might be different with the new ward data, and
+# why.
+@dataclass
+class BoundaryImpact:
+    changed_wards: list[WardNum]
+    changed_zipcodes: list[ZipCode]
+    num_members: int
+    # Members whose geocoded address is in an area that changed wards.
+    by_address: list[Uuid]
+    # Members tagged from their zipcode, whose zipcode's wards changed.
+    by_zipcode: list[Uuid]
+    # Members whose address hasn't been geocoded yet, so could be anywhere.
+    not_geocoded: list[Uuid]
+
+    def person_uuids(self) -> list[Uuid]:
+        return sorted(set(self.by_address) | set(self.by_zipcode) |
+                      set(self.not_geocoded))
+
+
+# Reads the ward data from before a change, given either a copy of the old
+# 'data/' directory, or just the old 'wards.json' (in which case the
+# zipcode data is assumed not to have changed).
+def load_old_ward_data(path: Path) -> WardData:
+    wards_path = path
+    zipcode_path = ZIPCODE_SOURCE_PATH
+    if path.is_dir():
+        wards_path = path / "wards.json"
+        if (path / "zipcode_to_wards.json").is_file():
+            zipcode_path = path / "zipcode_to_wards.json"
+    return parse_source_ward_data(wards_path, zipcode_path)
+
+
+# The area each ward gained or lost (i.e., the symmetric difference of its
+# old and new shapes), for each ward whose shape changed.
+def changed_ward_areas(old_data: WardData,
+                       new_data: WardData) -> dict[WardNum, BaseGeometry]:
+    old_shapes = dict(old_data.ward_shapes)
+    new_shapes = dict(new_data.ward_shapes)
+    changed_areas: dict[WardNum, BaseGeometry] = {}
+    for ward_num in sorted(old_shapes.keys() | new_shapes.keys()):
+        old_shape = old_shapes.get(ward_num)
+        new_shape = new_shapes.get(ward_num)
+        area: Optional[BaseGeometry]
+        if old_shape is None or new_shape is None:
+            area = old_shape if new_shape is None else new_shape
+        elif old_shape.equals(new_shape):
+            continue
+        else:
+            area = shapely.symmetric_difference(old_shape, new_shape)
+        if area is not None and not area.is_empty:
+            changed_areas[ward_num] = area
+    return changed_areas
+
+
+def changed_zipcodes(old_data: WardData, new_data: WardData,
+                     min_ward_sqft: float) -> list[ZipCode]:
+    old_wards = significant_wards(old_data.wards_for_zip, min_ward_sqft)
+    new_wards = significant_wards(new_data.wards_for_zip, min_ward_sqft)
+    return sorted(zipcode for zipcode in old_wards.keys() | new_wards.keys()
+                  if old_wards.get(zipcode, ()) != new_wards.get(zipcode, ()))
+
+
+# Works out which members' wards can change between the old and new ward
+# data, without geocoding anyone, by checking the cached coordinates of
+# each member's address against the areas that changed wards. Members
+# tagged from their 'Aldermanic Ward' field are never affected.
+def members_affected_by_ward_data_change(
+        old_data: WardData, new_data: WardData, members: list[Member],
+        min_ward_sqft: float, cache: TaggerCache) -> BoundaryImpact:
+    changed_areas = changed_ward_areas(old_data, new_data)
+    zipcodes = changed_zipcodes(old_data, new_data, min_ward_sqft)
+    impact = BoundaryImpact(sorted(changed_areas), zipcodes, len(members),
+                            [], [], [])
+
+    geocoded_members: list[Member] = []
+    lat_longs: list[tuple[float, float]] = []
+    zipcode_members: list[Member] = []
+    for member in members:
+        if member.custom_field_ward:
+            continue
+        address = address_to_geocode(member)
+        if not address:
+            zipcode_members.append(member)
+            continue
+        coords = cache.get_for_address(address)
+        if coords:
+            geocoded_members.append(member)
+            lat_longs.append(coords)
+        elif cache.check_failed_address(address):
+            zipcode_members.append(member)
+        else:
+            impact.not_geocoded.append(member.identifier)
+
+    if geocoded_members:
+        long_lats = np.array([(long, lat) for lat, long in lat_longs],
+                             dtype=np.float64)
+        tree = STRtree(np.asarray(shapely.points(long_lats)))
+        areas = np.array(list(changed_areas.values()), dtype=object)
+        _, point_indexes = tree.query(areas, predicate="intersects")
+        moved = np.zeros(len(geocoded_members), dtype=bool)
+        moved[point_indexes] = True
+        for index in np.flatnonzero(moved):
+            impact.by_address.append(geocoded_members[index].identifier)
+
+        # Members whose address isn't in any ward are tagged from their
+        # zipcode instead (and since their address isn't in a changed
+        # area, it isn't in a ward with the old data either).
+        new_index = WardIndex([WardShape(ward_num, shape)
+                               for ward_num, shape in new_data.ward_shapes])
+        unmoved = np.flatnonzero(~moved)
+        ward_nums = new_index.lookup_array_exact(long_lats[unmoved])
+        for index in unmoved[ward_nums == NO_WARD]:
+            zipcode_members.append(geocoded_members[index])
+
+    zipcode_set = set(zipcodes)
+    for member in zipcode_members:
+        if member.zipcode and member.zipcode in zipcode_set:
+            impact.by_zipcode.append(member.identifier)
+
+    logging.info("Wards with changed boundaries: %s", impact.changed_wards)
+    logging.info("Zipcodes with changed wards (with min sqft %s): %s",
+                 min_ward_sqft, impact.changed_zipcodes)
+    logging.info("%s of %s members may change wards: %s by address, %s by "
+                 "zipcode, and %s whose address hasn't been geocoded",
+                 len(impact.person_uuids()), impact.num_members,
+                 len(impact.by_address), len(impact.by_zipcode),
+                 len(impact.not_geocoded))
+    return impact
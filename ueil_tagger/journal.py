@@ -0,0 +1,133 @@
+from __future__ import annotations
+
+from dataclasses import asdict, dataclass, field
+import json
+import logging
+import os
+from pathlib import Path
+import time
+from typing import Optional, TYPE_CHECKING
+
+from ueil_tagger import STATE_DIR_PATH
+from ueil_tagger.types import TaggingsSummary
+
+if TYPE_CHECKING:
+    from ueil_tagger.cache import TaggerCache
+    from ueil_tagger.types import Shard, Uuid
+
+
+JOURNAL_PATH = STATE_DIR_PATH / "journal.json"
+# How often progress is written to the journal (and members are saved in the
+# batch cache) during a run.
+JOURNAL_SAVE_INTERVAL_SECS = 10.0
+
+
+# Each shard (see --shard) keeps its own journal, so shards running on the
+# same host can each be resumed.
+def journal_path(shard: Optional[Shard] = None) -> Path:
+    if not shard:
+        return JOURNAL_PATH
+    return STATE_DIR_PATH / f"journal-{shard.name}.json"
+
+
+@dataclass
+class RunJournal:
+    since: Optional[str]
+    started_at: str
+    # The first page of people records that hasn't been completely updated.
+    next_page: int = 1
+    # Summary of the updates made to members on the pages before next_page.
+    summary: Optional[dict[str, object]] = None
+    # Where the journal is stored (which isn't saved in the journal).
+    path: Path = field(default=JOURNAL_PATH, compare=False)
+
+    def save(self) -> None:
+        journal_data = asdict(self)
+        del journal_data["path"]
+        # Write to a temp file and then move it into place, so that the
+        # journal is never left partially written if we crash.
+        temp_path = self.path.with_suffix(".tmp")
+        temp_path.write_text(json.dumps(journal_data))
+        os.replace(temp_path, self.path)
+
+    @classmethod
+    def load(cls, journal_path: Path = JOURNAL_PATH) -> Optional[RunJournal]:
+        if not journal_path.is_file():
+            return None
+        try:
+            return cls(**json.loads(journal_path.read_text()),
+                       path=journal_path)
+        except (ValueError, TypeError):
+            logging.error("Invalid run journal stored in '%s'", journal_path)
+            return None
+
+    @staticmethod
+    def clear(journal_path: Path = JOURNAL_PATH) -> None:
+        journal_path.unlink(missing_ok=True)
+
+
+# Tracks which pages of people records have been completely updated (even
+# though members from several pages can be updated at once), and
+# periodically records that progress to the run journal and batch cache.
+class RunProgress:
+    journal: Optional[RunJournal]
+    batch_cache: Optional[TaggerCache]
+    summary: TaggingsSummary
+    page_summaries: dict[int, TaggingsSummary]
+    page_remaining: dict[int, int]
+    finished_uuids: list[Uuid]
+    last_save: float
+
+    def __init__(self, journal: Optional[RunJournal] = None,
+                 batch_cache: Optional[TaggerCache] = None) -> None:
+        self.journal = journal
+        self.batch_cache = batch_cache
+        self.summary = TaggingsSummary()
+        if journal and journal.summary:
+            self.summary = TaggingsSummary.from_dict(journal.summary)
+        self.page_summaries = {}
+        self.page_remaining = {}
+        self.finished_uuids = []
+        self.last_save = time.monotonic()
+
+    # Starts tracking a page with num_members left to update, after
+    # num_skipped were skipped as unchanged. A page with no one left to
+    # update may be committed straight away.
+    def start_page(self, page_index: int, num_members: int,
+                   num_skipped: int = 0) -> None:
+        self.page_summaries[page_index] = TaggingsSummary(
+            members_skipped=num_skipped)
+        self.page_remaining[page_index] = num_members
+        self.__commit_finished_pages()
+
+    def finish_member(self, page_index: int, member_uuid: Uuid,
+                      member_summary: TaggingsSummary) -> None:
+        self.page_summaries[page_index].merge(member_summary)
+        self.page_remaining[page_index] -= 1
+        self.finished_uuids.append(member_uuid)
+        self.__commit_finished_pages()
+        if time.monotonic() - self.last_save >= JOURNAL_SAVE_INTERVAL_SECS:
+            self.save()
+
+    def __commit_finished_pages(self) -> None:
+        # Pages are started in order, so the progress cursor can move past
+        # each page once it, and every page before it, is finished.
+        while self.page_remaining:
+            page_index = next(iter(self.page_remaining))
+            if self.page_remaining[page_index] > 0:
+                break
+            del self.page_remaining[page_index]
+            self.summary.merge(self.page_summaries.pop(page_index))
+            if self.journal:
+                self.journal.next_page = page_index + 1
+
+    def save(self) -> None:
+        if self.batch_cache and self.finished_uuids:
+            logging.info("Saving %s members in cache",
+                         len(self.finished_uuids))
+            self.batch_cache.set_member_uuids(self.finished_uuids)
+        self.finished_uuids = []
+        if self.journal:
+            self.journal.summary = self.summary.to_dict()
+            self.journal.save()
+        self.last_save = time.monotonic()
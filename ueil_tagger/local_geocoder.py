@@ -0,0 +1,230 @@
+from __future__ import annotations
+
+import csv
+import hashlib
+import json
+import logging
+from pathlib import Path
+import sqlite3
+import threading
+from typing import Any, Iterator, Optional, TYPE_CHECKING
+
+from ueil_tagger import STATE_DIR_PATH
+from ueil_tagger.addresses import address_tokens, DIRECTION_ABBREVIATIONS
+from ueil_tagger.addresses import STREET_SUFFIX_ABBREVIATIONS
+from ueil_tagger.types import Coords
+
+if TYPE_CHECKING:
+    from ueil_tagger.geolocate import GeocoderBackend
+    from ueil_tagger.types import StreetAddress
+
+
+INDEX_PATH = STATE_DIR_PATH / "address_points.sqlite3"
+
+# Address point datasets (e.g., the City of Chicago and Cook County ones)
+# don't agree on column names, so each part of the address is read from
+# the first of these columns that the dataset has.
+NUMBER_COLUMNS = ["add_number", "addrnocom", "addrno", "address_number",
+                  "house_number", "number"]
+DIRECTION_COLUMNS = ["st_predir", "stnameprd", "pre_dir", "predir",
+                     "direction"]
+NAME_COLUMNS = ["st_name", "stname", "street_name", "street"]
+SUFFIX_COLUMNS = ["st_type", "stnamepot", "street_type", "suffix"]
+LATITUDE_COLUMNS = ["latitude", "lat", "y"]
+LONGITUDE_COLUMNS = ["longitude", "lon", "long", "x"]
+
+DIRECTIONS = set(DIRECTION_ABBREVIATIONS.values())
+STREET_SUFFIXES = set(STREET_SUFFIX_ABBREVIATIONS.values())
+UNIT_DESIGNATORS = {"apt", "ste", "unit", "fl", "floor", "rm", "room"}
+
+# Street numbers, directions, names and suffixes are joined with a
+# separator that can't appear in a normalized address, so that prefix
+# searches can't match across parts.
+KEY_SEPARATOR = "|"
+
+
+def address_point_key(number: str, direction: str, name: str,
+                      suffix: str) -> str:
+    parts = [number, direction, name, suffix]
+    return KEY_SEPARATOR.join(" ".join(address_tokens(p)) for p in parts)
+
+
+def parse_street_address(
+        address: StreetAddress) -> Optional[tuple[str, str, str, str]]:
+    street_line, *other_parts = address.split(",")
+    # Only Chicago addresses are in the index, so addresses that say
+    # they're somewhere else can be skipped.
+    other_parts = [" ".join(address_tokens(part)) for part in other_parts]
+    if other_parts and "chicago" not in other_parts:
+        return None
+
+    tokens = address_tokens(street_line)
+    if len(tokens) < 2 or not tokens[0].isdigit():
+        return None
+    number, *tokens = tokens
+
+    direction = ""
+    if len(tokens) > 1 and tokens[0] in DIRECTIONS:
+        direction, *tokens = tokens
+
+    for index, token in enumerate(tokens):
+        if token in UNIT_DESIGNATORS:
+            tokens = tokens[:index]
+            break
+
+    suffix = ""
+    if len(tokens) > 1 and tokens[-1] in STREET_SUFFIXES:
+        suffix = tokens.pop()
+    if not tokens:
+        return None
+    return number, direction, " ".join(tokens), suffix
+
+
+def column_value(record: dict[str, Any], columns: list[str]) -> str:
+    for column in columns:
+        if column in record and record[column] is not None:
+            return str(record[column]).strip()
+    return ""
+
+
+def read_source_records(source_path: Path) -> Iterator[dict[str, Any]]:
+    if source_path.suffix.lower() in (".json", ".geojson"):
+        features = json.loads(source_path.read_text())["features"]
+        for feature in features:
+            if not feature.get("geometry"):
+                continue
+            long, lat = feature["geometry"]["coordinates"][0:2]
+            yield feature["properties"] | {"longitude": long, "latitude": lat}
+        return
+
+    with source_path.open(newline="") as handle:
+        yield from csv.DictReader(handle)
+
+
+def read_address_points(
+        source_path: Path) -> Iterator[tuple[str, float, float]]:
+    for source_record in read_source_records(source_path):
+        record = {k.lower(): v for k, v in source_record.items() if k}
+        number = column_value(record, NUMBER_COLUMNS)
+        name = column_value(record, NAME_COLUMNS)
+        try:
+            lat = float(column_value(record, LATITUDE_COLUMNS))
+            long = float(column_value(record, LONGITUDE_COLUMNS))
+        except ValueError:
+            continue
+        if not number or not name:
+            continue
+        key = address_point_key(number,
+                                column_value(record, DIRECTION_COLUMNS),
+                                name, column_value(record, SUFFIX_COLUMNS))
+        yield key, lat, long
+
+
+class LocalAddressIndex:
+    source_path: Path
+    index_path: Path
+    connection: sqlite3.Connection
+    lock: threading.Lock
+
+    def __init__(self, source_path: Path,
+                 index_path: Path = INDEX_PATH) -> None:
+        self.source_path = source_path
+        self.index_path = index_path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(index_path,
+                                          check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS meta "
+            "(key TEXT PRIMARY KEY, value TEXT)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS points "
+            "(key TEXT PRIMARY KEY, lat REAL, long REAL) WITHOUT ROWID")
+        source_hash = hashlib.sha256(source_path.read_bytes()).hexdigest()
+        if self.__meta("source_hash") != source_hash:
+            self.__rebuild(source_hash)
+
+    def __meta(self, key: str) -> Optional[str]:
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return str(row[0]) if row else None
+
+    def __rebuild(self, source_hash: str) -> None:
+        logging.info("Building local address index from '%s'",
+                     self.source_path)
+        with self.connection:
+            self.connection.execute("DELETE FROM points")
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO points (key, lat, long) "
+                "VALUES (?, ?, ?)", read_address_points(self.source_path))
+            self.connection.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                ("source_hash", source_hash))
+        num_points = self.connection.execute(
+            "SELECT COUNT(*) FROM points").fetchone()[0]
+        logging.info("Indexed %s address points", num_points)
+
+    def __exact(self, key: str) -> Optional[Coords]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT lat, long FROM points WHERE key = ?",
+                (key,)).fetchone()
+        return Coords(row[0], row[1]) if row else None
+
+    def __prefix(self, prefix: str) -> list[tuple[str, float, float]]:
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT key, lat, long FROM points "
+                "WHERE key >= ? AND key < ?",
+                (prefix, prefix + "\uffff")).fetchall()
+        return [(str(key), float(lat), float(long))
+                for key, lat, long in rows]
+
+    def lookup(self, address: StreetAddress) -> Optional[Coords]:
+        parsed_address = parse_street_address(address)
+        if not parsed_address:
+            return None
+        number, direction, name, _ = parsed_address
+        coords = self.__exact(address_point_key(*parsed_address))
+        if coords:
+            return coords
+
+        # Otherwise, fall back to matching on a prefix of the address (to
+        # handle missing or wrong suffixes and directions, or truncated
+        # street names), but only if there is a single possible match.
+        candidates = self.__prefix(
+            KEY_SEPARATOR.join([number, direction, name]))
+        if not candidates and not direction:
+            number_prefix = number + KEY_SEPARATOR
+            candidates = [c for c in self.__prefix(number_prefix)
+                          if c[0].split(KEY_SEPARATOR)[2].startswith(name)]
+        if len(candidates) != 1:
+            if candidates:
+                logging.debug(" * '%s' matches %s local address points",
+                              address, len(candidates))
+            return None
+        _, lat, long = candidates[0]
+        return Coords(lat, long)
+
+
+class LocalAddressBackend:
+    index: LocalAddressIndex
+
+    def __init__(self, index: LocalAddressIndex) -> None:
+        self.index = index
+
+    def geocode(self, address: StreetAddress) -> Optional[Coords]:
+        return self.index.lookup(address)
+
+
+class FallbackBackend:
+    backends: list[GeocoderBackend]
+
+    def __init__(self, *backends: GeocoderBackend) -> None:
+        self.backends = list(backends)
+
+    def geocode(self, address: StreetAddress) -> Optional[Coords]:
+        for backend in self.backends:
+            coords = backend.geocode(address)
+            if coords:
+                return coords
+        return None
@@ -1,17 +1,37 @@
 from __future__ import annotations
 
+from collections import deque
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from datetime import datetime
 import json
 import logging
-from typing import Optional, TYPE_CHECKING
+from typing import Callable, Iterable, Iterator, Optional, TypeVar
+from typing import TYPE_CHECKING
 
-from ueil_tagger.cache import TaggerCache
+import requests
+
+from ueil_tagger.cache import get_tagger_cache, TaggerCache
 from ueil_tagger.client import Client
-from ueil_tagger.types import Member, TaggingsSummary, WardTaggingStrategy
-from ueil_tagger.wards import get_ward_id_to_uuid_map, wards_for_member
+from ueil_tagger.journal import RunJournal, RunProgress
+from ueil_tagger.metrics import timed_stage
+from ueil_tagger.tracing import traced
+from ueil_tagger.types import Member, MemberFingerprint, MemberTagPlan
+from ueil_tagger.types import TaggingsSummary
+from ueil_tagger.types import WardTaggingStrategy
+from ueil_tagger.wards import address_to_geocode, get_ward_id_to_uuid_map
+from ueil_tagger.wards import get_ward_taggings_snapshot, ward_data_version
+from ueil_tagger.wards import wards_for_addresses, wards_for_member
 
 if TYPE_CHECKING:
     from ueil_tagger.types import Uuid, ZipCode, WardToTagMap, WebAPIRecord
+    from ueil_tagger.types import PersonToTagsMap, Shard, WardNum
+    from ueil_tagger.plan import PlanWriter
+    from ueil_tagger.wards import AddressWardMap
+
+
+T = TypeVar("T")
+R = TypeVar("R")
 
 
 def field_to_zip(field: Optional[str]) -> Optional[ZipCode]:
@@ -65,152 +85,415 @@ def get_member_from_record(record: WebAPIRecord) -> Optional[Member]:
 
     member = Member(record_uuid, address.get("address_lines"),
                     address.get("locality"), address.get("region"),
-                    zipcode, custom_field_ward)
+                    zipcode, custom_field_ward, record.get("modified_date"))
     return member
 
 
+@timed_stage("people page")
+def get_members_page(
+        client: Client, page_index: int,
+        since: Optional[datetime] = None) -> tuple[list[Member], int]:
+    logging.info("Requesting people records, page=%s", page_index)
+    people_response = client.get_people(page_index, since)
+    records = people_response["_embedded"]["osdi:people"]
+    logging.info("...received %s additional records", len(records))
+
+    members = []
+    for record in records:
+        member = get_member_from_record(record)
+        if not member:
+            logging.error("Unable to parse API response as a member:\n%s",
+                          json.dumps(record))
+            continue
+
+        if since:
+            modified_date = record["modified_date"]
+            modified_date = datetime.fromisoformat(modified_date)
+            if modified_date < since:
+                raise ValueError(
+                    "Unexpected person result\n"
+                    f"person={member.identifier}: was updated "
+                    f"after the given date '{modified_date}'")
+        members.append(member)
+    total_pages = int(people_response.get("total_pages", 0))
+    return members, total_pages
+
+
+def iter_member_pages(
+        client: Client, since: Optional[datetime] = None,
+        prefetch: int = 2,
+        start_page: int = 1) -> Iterator[tuple[int, list[Member]]]:
+    members, total_pages = get_members_page(client, start_page, since)
+    yield start_page, members
+    if total_pages == 0:
+        # If the response didn't say how many pages there are, fall back
+        # to reading pages until we get an empty one.
+        page_index = start_page
+        while members:
+            page_index += 1
+            members, _ = get_members_page(client, page_index, since)
+            yield page_index, members
+        return
+
+    # Otherwise, request the next few pages in the background while the
+    # caller works through the current one.
+    with ThreadPoolExecutor(max_workers=max(prefetch, 1)) as executor:
+        pending: deque[tuple[int, Future[tuple[list[Member], int]]]]
+        pending = deque()
+        next_page = start_page + 1
+        while pending or next_page <= total_pages:
+            while next_page <= total_pages and len(pending) <= prefetch:
+                future = executor.submit(get_members_page, client, next_page,
+                                         since)
+                pending.append((next_page, future))
+                next_page += 1
+            page_index, future = pending.popleft()
+            members, _ = future.result()
+            yield page_index, members
+
+
+def iter_members_updated_since(
+        client: Client, since: Optional[datetime] = None,
+        prefetch: int = 2) -> Iterator[Member]:
+    for _, members in iter_member_pages(client, since, prefetch):
+        yield from members
+
+
 def get_members_updated_since(
         client: Client, since: Optional[datetime] = None) -> list[Member]:
-    members = []
-    page_index = 1
-    while True:
-        logging.info("Requesting people records, page=%s", page_index)
-        people_response = client.get_people(page_index, since)
-        records = people_response["_embedded"]["osdi:people"]
-
-        logging.info("...received %s additional records", len(records))
-        if len(records) == 0:
-            break
-
-        for record in records:
-            member = get_member_from_record(record)
-            if not member:
-                logging.error("Unable to parse API response as a member:\n%s",
-                              json.dumps(record))
-                continue
-
-            if since:
-                modified_date = record["modified_date"]
-                modified_date = datetime.fromisoformat(modified_date)
-                if modified_date < since:
-                    raise ValueError(
-                        "Unexpected person result\n"
-                        f"person={member.identifier}: was updated "
-                        f"after the given date '{modified_date}'")
-            members.append(member)
-        page_index += 1
-    return members
-
-
-def clear_ward_tags_from_member(client: Client, member: Member,
-                                ward_to_tag_map: WardToTagMap) -> int:
+    return list(iter_members_updated_since(client, since))
+
+
+@timed_stage("member taggings read")
+def get_ward_taggings_for_member(client: Client, member: Member,
+                                 ward_to_tag_map: WardToTagMap) -> set[Uuid]:
     ward_tag_uuids = ward_to_tag_map.values()
     taggings_for_member = client.get_taggings_for_person(member.identifier)
-    ward_tags_for_member = set(ward_tag_uuids) & set(taggings_for_member)
+    return set(ward_tag_uuids) & set(taggings_for_member)
+
+
+def member_is_unchanged(member: Member, min_sqft: int) -> bool:
+    fingerprint = get_tagger_cache().get_member_fingerprint(member.identifier)
+    if not fingerprint:
+        return False
+    return (fingerprint.fingerprint == member.fingerprint() and
+            fingerprint.ward_data_version == ward_data_version(min_sqft))
 
-    num_tags_removed = 0
-    for tag_uuid in ward_tags_for_member:
-        logging.info("person=%s: removing tagging %s",
-                     member.identifier, tag_uuid)
-        client.delete_tagging_for_person(tag_uuid, member.identifier)
-        num_tags_removed += 1
-    return num_tags_removed
+
+# Reads person uuids from lines of text (e.g., a file exported from another
+# tool), skipping blank lines and comments.
+def read_person_uuids(lines: Iterable[str]) -> Iterator[Uuid]:
+    for line in lines:
+        person_uuid = line.split("#", 1)[0].strip()
+        if person_uuid:
+            yield person_uuid.removeprefix("action_network:")
 
 
 def set_ward_tags_for_member_uuid(
         client: Client, person_uuid: Uuid, min_sqft: int,
-        summary: Optional[TaggingsSummary] = None) -> TaggingsSummary:
+        summary: Optional[TaggingsSummary] = None,
+        ward_to_tag_map: Optional[WardToTagMap] = None,
+        incremental: bool = False) -> TaggingsSummary:
     if not summary:
         summary = TaggingsSummary()
-    result = client.get_person(person_uuid)
+    try:
+        result = client.get_person(person_uuid)
+    except requests.RequestException as e:
+        logging.error("Unable to load person uuid=%s: %s", person_uuid, e)
+        summary.error_count += 1
+        return summary
     member = get_member_from_record(result)
     if not member:
         logging.error("Unable to load a person result for uuid=%s",
                       person_uuid)
         summary.error_count += 1
         return summary
-    ward_to_tag_map = get_ward_id_to_uuid_map(client)
+    if ward_to_tag_map is None:
+        ward_to_tag_map = get_ward_id_to_uuid_map(client)
     set_ward_tags_for_member(client, member, min_sqft, ward_to_tag_map,
-                             summary)
+                             summary, incremental=incremental)
     return summary
 
 
+# Updates each of the given people, looking up the ward tags once, and
+# fetching and updating up to workers people at a time. Uuids are read as
+# they're needed, so they can be streamed in (e.g., from stdin).
+def set_ward_tags_for_member_uuids(
+        client: Client, person_uuids: Iterable[Uuid], min_sqft: int,
+        workers: int = 1, incremental: bool = False) -> TaggingsSummary:
+    summary = TaggingsSummary()
+    ward_to_tag_map = get_ward_id_to_uuid_map(client)
+    seen_uuids: set[Uuid] = set()
+
+    def unseen_uuids() -> Iterator[Uuid]:
+        for person_uuid in person_uuids:
+            if person_uuid not in seen_uuids:
+                seen_uuids.add(person_uuid)
+                yield person_uuid
+
+    run_with_workers(
+        lambda person_uuid: set_ward_tags_for_member_uuid(
+            client, person_uuid, min_sqft, None, ward_to_tag_map,
+            incremental),
+        unseen_uuids(), summary.merge, workers)
+    logging.info("Updated %s people by uuid", len(seen_uuids))
+    return summary
+
+
+@timed_stage("member plan")
+def plan_ward_tags_for_member(
+        client: Client, member: Member, min_sqft: int,
+        ward_to_tag_map: WardToTagMap, summary: TaggingsSummary,
+        address_wards: Optional[AddressWardMap] = None,
+        ward_taggings: Optional[PersonToTagsMap] = None) -> MemberTagPlan:
+    ward_result = wards_for_member(member, min_sqft, address_wards)
+    wards: list[WardNum] = []
+    if not ward_result:
+        summary.members_not_tagged += 1
+        logging.info("person=%s: not tagging to any wards",
+                     member.identifier)
+    else:
+        wards, strategy = ward_result
+        match strategy:
+            case WardTaggingStrategy.FIELD:
+                summary.members_tagged_from_field += 1
+            case WardTaggingStrategy.ADDRESS:
+                summary.members_tagged_from_address += 1
+            case WardTaggingStrategy.ZIPCODE:
+                summary.members_tagged_from_zipcode += 1
+
+    # Only touch the taggings that differ from what the member should
+    # have, instead of removing and re-adding all of them.
+    if ward_taggings is not None:
+        current_tag_uuids = ward_taggings.get(member.identifier, set())
+    else:
+        current_tag_uuids = get_ward_taggings_for_member(client, member,
+                                                         ward_to_tag_map)
+    wanted_tag_uuids = {ward_to_tag_map[ward] for ward in wards}
+    tag_uuids_to_add = sorted(wanted_tag_uuids - current_tag_uuids)
+    tag_uuids_to_remove = sorted(current_tag_uuids - wanted_tag_uuids)
+    return MemberTagPlan(member.identifier, wards, tag_uuids_to_add,
+                         tag_uuids_to_remove)
+
+
+@timed_stage("member apply")
+def apply_member_tag_plan(client: Client, plan: MemberTagPlan,
+                          summary: TaggingsSummary) -> MemberTagPlan:
+    failed_plan = MemberTagPlan(plan.person, plan.wards, [], [])
+    if plan.is_empty():
+        logging.info("person=%s: ward taggings are already correct",
+                     plan.person)
+        summary.members_unchanged += 1
+        return failed_plan
+
+    for tag_uuid in plan.remove_tags:
+        logging.info("person=%s: removing tagging %s", plan.person, tag_uuid)
+        if not client.delete_tagging_for_person(tag_uuid, plan.person):
+            failed_plan.remove_tags.append(tag_uuid)
+            summary.error_count += 1
+            continue
+        summary.taggings_deleted += 1
+
+    for tag_uuid in plan.add_tags:
+        logging.info("person=%s: adding tagging %s (wards=%s)",
+                     plan.person, tag_uuid, plan.wards)
+        if not client.set_tagging_for_person(tag_uuid, plan.person):
+            failed_plan.add_tags.append(tag_uuid)
+            summary.error_count += 1
+            continue
+        summary.taggings_added += 1
+    summary.members_modified += 1
+    return failed_plan
+
+
+@traced("set_ward_tags_for_member")
 def set_ward_tags_for_member(
         client: Client, member: Member, min_sqft: int,
         ward_to_tag_map: Optional[WardToTagMap] = None,
-        summary: Optional[TaggingsSummary] = None) -> TaggingsSummary:
+        summary: Optional[TaggingsSummary] = None,
+        address_wards: Optional[AddressWardMap] = None,
+        ward_taggings: Optional[PersonToTagsMap] = None,
+        incremental: bool = False,
+        plan_writer: Optional[PlanWriter] = None) -> TaggingsSummary:
     if not summary:
         summary = TaggingsSummary()
     if not ward_to_tag_map:
         ward_to_tag_map = get_ward_id_to_uuid_map(client)
 
-    num_taggings_removed = clear_ward_tags_from_member(client, member,
-                                                       ward_to_tag_map)
-    summary.taggings_deleted += num_taggings_removed
-    ward_result = wards_for_member(member, min_sqft)
+    if incremental and member_is_unchanged(member, min_sqft):
+        logging.info("person=%s: address and ward fields are unchanged, "
+                     "skipping", member.identifier)
+        summary.members_skipped += 1
+        return summary
 
-    if not ward_result:
-        summary.members_not_tagged += 1
-        if num_taggings_removed > 0:
+    plan = plan_ward_tags_for_member(client, member, min_sqft,
+                                     ward_to_tag_map, summary, address_wards,
+                                     ward_taggings)
+    # When only planning, the changes are written out to be applied later,
+    # and counted as if they had been made.
+    if plan_writer:
+        plan_writer.write(plan)
+        if plan.is_empty():
+            summary.members_unchanged += 1
+        else:
             summary.members_modified += 1
-        logging.info("person=%s: not tagging to any wards",
-                     member.identifier)
+            summary.taggings_added += len(plan.add_tags)
+            summary.taggings_deleted += len(plan.remove_tags)
         return summary
 
-    wards, strategy = ward_result
-    match strategy:
-        case WardTaggingStrategy.FIELD:
-            summary.members_tagged_from_field += 1
-        case WardTaggingStrategy.ADDRESS:
-            summary.members_tagged_from_address += 1
-        case WardTaggingStrategy.ZIPCODE:
-            summary.members_tagged_from_zipcode += 1
-
-    for ward in wards:
-        ward_tag_uuid = ward_to_tag_map[ward]
-        client.set_tagging_for_person(ward_tag_uuid, member.identifier)
-        logging.info("person=%s: tagging to ward=%s (%s)",
-                     member.identifier, ward_tag_uuid, ward)
-        summary.taggings_added += 1
-    summary.members_modified += 1
+    failed_plan = apply_member_tag_plan(client, plan, summary)
+
+    # Keep the given taggings up to date with the changes that were made
+    # (e.g., so they can be saved to the mirror).
+    if ward_taggings is not None and not client.read_only:
+        tag_uuids = ward_taggings.get(member.identifier, set())
+        tag_uuids = tag_uuids - (set(plan.remove_tags) -
+                                 set(failed_plan.remove_tags))
+        tag_uuids = tag_uuids | (set(plan.add_tags) -
+                                 set(failed_plan.add_tags))
+        ward_taggings[member.identifier] = tag_uuids
+
+    # Only remember members whose taggings are known to be correct, so
+    # that failed (or dry run) updates are retried on the next run.
+    if incremental and failed_plan.is_empty() and not client.read_only:
+        fingerprint = MemberFingerprint(member.fingerprint(), plan.wards,
+                                        ward_data_version(min_sqft))
+        get_tagger_cache().set_member_fingerprint(member.identifier,
+                                                  fingerprint)
     return summary
 
 
+def finish_member_updates(
+        pending: dict[Future[TaggingsSummary], tuple[int, Member]],
+        progress: RunProgress,
+        return_when: str = ALL_COMPLETED) -> int:
+    done, _ = wait(pending, return_when=return_when)
+    for future in done:
+        page_index, member = pending.pop(future)
+        progress.finish_member(page_index, member.identifier, future.result())
+        logging.info("Updated member %s", member.identifier)
+    return len(done)
+
+
+# Calls func with each item, on up to workers threads, and passes each
+# result to on_result (on the calling thread) as it finishes. Only a few
+# items per worker are taken from items ahead of time, so they can be read
+# lazily.
+def run_with_workers(func: Callable[[T], R], items: Iterable[T],
+                     on_result: Callable[[R], None],
+                     workers: int = 1) -> None:
+    def finish(futures: set[Future[R]],
+               return_when: str) -> set[Future[R]]:
+        done, not_done = wait(futures, return_when=return_when)
+        for future in done:
+            on_result(future.result())
+        return not_done
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending: set[Future[R]] = set()
+        for item in items:
+            pending.add(executor.submit(func, item))
+            if len(pending) > workers * 2:
+                pending = finish(pending, FIRST_COMPLETED)
+        finish(pending, ALL_COMPLETED)
+
+
 def set_ward_tags_for_all_members_since(
         client: Client, min_sqft: int,
         batch: bool = False,
-        since: Optional[datetime] = None) -> TaggingsSummary:
-    summary = TaggingsSummary()
+        since: Optional[datetime] = None,
+        workers: int = 1,
+        snapshot_taggings: bool = False,
+        prefetch_pages: int = 2,
+        incremental: bool = False,
+        journal: Optional[RunJournal] = None,
+        plan_writer: Optional[PlanWriter] = None,
+        shard: Optional[Shard] = None) -> TaggingsSummary:
     if since:
         logging.info("Tagging members updated since %s", since.isoformat())
     else:
         logging.info("Tagging all members")
 
+    if shard:
+        logging.info("Only updating members in shard %s", shard)
+
     batch_cache: Optional[TaggerCache] = None
     if batch:
         logging.info("Updating members who are not in batch")
-        batch_cache = TaggerCache()
+        batch_cache = get_tagger_cache()
+
+    start_page = 1
+    if journal:
+        start_page = journal.next_page
+        if start_page > 1:
+            logging.info("Resuming run started at %s, from page %s",
+                         journal.started_at, start_page)
+    progress = RunProgress(journal, batch_cache)
 
     ward_to_tag_map = get_ward_id_to_uuid_map(client)
-    members = get_members_updated_since(client, since)
-    members.sort(key=lambda m: m.identifier)
-
-    num_members = len(members)
-    logging.info("%s members to update", num_members)
-    member_index = 0
-    for member in members:
-        member_index += 1
-        member_uuid = member.identifier
-        if batch_cache and batch_cache.check_member_uuid(member_uuid):
-            logging.info("(%s/%s) Skipping member %s, in cache",
-                         member_index, num_members, member_uuid)
-            continue
-        else:
-            logging.info("(%s/%s) Updating member %s",
-                         member_index, num_members, member_uuid)
-            set_ward_tags_for_member(client, member, min_sqft, ward_to_tag_map,
-                                     summary)
-            if batch_cache:
-                logging.info("Saving %s in cache", member_uuid)
-                batch_cache.set_member_uuid(member_uuid)
-    return summary
+    ward_taggings: Optional[PersonToTagsMap] = None
+    if snapshot_taggings:
+        logging.info("Loading current ward taggings for all people")
+        ward_taggings = get_ward_taggings_snapshot(client, ward_to_tag_map)
+
+    logging.info("Updating members using %s worker(s)", workers)
+    # Each member is tagged with their own summary, and the summaries (and
+    # the batch cache and journal) are only updated from this thread, as
+    # each member is finished.
+    executor = ThreadPoolExecutor(max_workers=workers)
+    pending: dict[Future[TaggingsSummary], tuple[int, Member]] = {}
+    num_updated = 0
+    try:
+        for page_index, members in iter_member_pages(
+                client, since, prefetch_pages, start_page):
+            members_to_update = []
+            num_skipped = 0
+            for member in members:
+                member_uuid = member.identifier
+                if shard and not shard.contains(member_uuid):
+                    continue
+                if batch_cache and batch_cache.check_member_uuid(member_uuid):
+                    logging.info("Skipping member %s, in cache", member_uuid)
+                    continue
+                if incremental and member_is_unchanged(member, min_sqft):
+                    logging.info("Skipping member %s, unchanged", member_uuid)
+                    num_skipped += 1
+                    continue
+                members_to_update.append(member)
+            progress.start_page(page_index, len(members_to_update),
+                                num_skipped)
+
+            # Assign wards to every address on the page that's already been
+            # geocoded in a single pass. The rest are geocoded by the
+            # workers, alongside their other requests, instead of holding
+            # up this thread.
+            addresses = []
+            for member in members_to_update:
+                address = address_to_geocode(member)
+                if address:
+                    addresses.append(address)
+            address_wards = wards_for_addresses(addresses, cached_only=True)
+            logging.info("Found %s of %s member addresses from page %s in "
+                         "the geocode cache", len(address_wards),
+                         len(set(addresses)), page_index)
+
+            for member in members_to_update:
+                future = executor.submit(
+                    set_ward_tags_for_member, client, member, min_sqft,
+                    ward_to_tag_map, None, address_wards, ward_taggings,
+                    incremental, plan_writer)
+                pending[future] = (page_index, member)
+
+            # Don't read pages too far ahead of the workers.
+            while len(pending) > workers * 2:
+                num_updated += finish_member_updates(pending, progress,
+                                                     FIRST_COMPLETED)
+        num_updated += finish_member_updates(pending, progress)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        # Record whatever was finished, so that a failed run can be resumed.
+        progress.save()
+    if journal:
+        RunJournal.clear(journal.path)
+    logging.info("Updated %s members", num_updated)
+    return progress.summary
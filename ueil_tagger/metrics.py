@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+from contextlib import contextmanager
+import copy
+import functools
+import os
+from pathlib import Path
+import threading
+import time
+from typing import Callable, Iterator, ParamSpec, TypeVar, TYPE_CHECKING
+
+from ueil_tagger.tracing import get_tracer
+from ueil_tagger.types import LATENCY_BUCKETS_SECS, StageMetrics
+
+if TYPE_CHECKING:
+    from ueil_tagger.types import TaggingsSummary
+
+
+P = ParamSpec("P")
+R = TypeVar("R")
+
+PROMETHEUS_PREFIX = "ueil_tagger"
+
+
+# Collects stage metrics from every thread in the process.
+class MetricsCollector:
+    metrics: StageMetrics
+    lock: threading.Lock
+
+    def __init__(self) -> None:
+        self.metrics = StageMetrics()
+        self.lock = threading.Lock()
+
+    def observe(self, stage: str, secs: float, num_bytes: int = 0,
+                retries: int = 0, error: bool = False) -> None:
+        with self.lock:
+            self.metrics.stage(stage).observe(secs, num_bytes, retries, error)
+
+    # Timed stages are also traced, as spans named for the stage.
+    @contextmanager
+    def timed(self, stage: str) -> Iterator[None]:
+        start_time = time.perf_counter()
+        error = False
+        try:
+            with get_tracer().span(stage):
+                yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - start_time,
+                         error=error)
+
+    def snapshot(self) -> StageMetrics:
+        with self.lock:
+            return copy.deepcopy(self.metrics)
+
+
+@functools.cache
+def get_metrics() -> MetricsCollector:
+    return MetricsCollector()
+
+
+def timed_stage(stage: str) -> Callable[[Callable[P, R]], Callable[P, R]]:
+    def decorator(func: Callable[P, R]) -> Callable[P, R]:
+        @functools.wraps(func)
+        def wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
+            with get_metrics().timed(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def prometheus_text(summary: TaggingsSummary) -> str:
+    prefix = PROMETHEUS_PREFIX
+    lines = []
+    counts = {
+        "taggings_deleted": summary.taggings_deleted,
+        "taggings_added": summary.taggings_added,
+        "members_modified": summary.members_modified,
+        "members_unchanged": summary.members_unchanged,
+        "members_skipped": summary.members_skipped,
+        "members_tagged_from_field": summary.members_tagged_from_field,
+        "members_tagged_from_address": summary.members_tagged_from_address,
+        "members_tagged_from_zipcode": summary.members_tagged_from_zipcode,
+        "members_not_tagged": summary.members_not_tagged,
+        "errors": summary.error_count,
+        "concurrency_limit": summary.concurrency.limit,
+        "concurrency_throttle_events": summary.concurrency.throttle_events,
+        "concurrency_latency_events": summary.concurrency.latency_events,
+        "concurrency_error_events": summary.concurrency.error_events,
+    }
+    for name, value in counts.items():
+        lines.append(f"# TYPE {prefix}_{name} gauge")
+        lines.append(f"{prefix}_{name} {value}")
+
+    stages = sorted(summary.metrics.stages.items())
+    lines.append(f"# TYPE {prefix}_stage_seconds histogram")
+    for stage, stats in stages:
+        cumulative_count = 0
+        bounds = [str(b) for b in LATENCY_BUCKETS_SECS] + ["+Inf"]
+        for bound, bucket_count in zip(bounds, stats.histogram):
+            cumulative_count += bucket_count
+            lines.append(f'{prefix}_stage_seconds_bucket{{stage="{stage}",'
+                         f'le="{bound}"}} {cumulative_count}')
+        lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} '
+                     f'{stats.total_secs}')
+        lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} '
+                     f'{stats.count}')
+    for name, attr in (("bytes", "num_bytes"), ("retries", "retries"),
+                       ("errors", "errors")):
+        lines.append(f"# TYPE {prefix}_stage_{name}_total counter")
+        for stage, stats in stages:
+            lines.append(f'{prefix}_stage_{name}_total{{stage="{stage}"}} '
+                         f'{getattr(stats, attr)}')
+    return "\n".join(lines) + "\n"
+
+
+# Written to a temporary file first, so that the node exporter's textfile
+# collector never reads a partially written file.
+def write_prometheus_textfile(summary: TaggingsSummary, path: Path) -> None:
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_text(prometheus_text(summary))
+    os.replace(tmp_path, path)
@@ -0,0 +1,276 @@
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import json
+import logging
+from pathlib import Path
+import sqlite3
+import threading
+from types import TracebackType
+from typing import Iterator, Optional, TYPE_CHECKING
+
+from ueil_tagger import STATE_DIR_PATH
+from ueil_tagger.members import get_ward_taggings_for_member
+from ueil_tagger.members import iter_member_pages, member_is_unchanged
+from ueil_tagger.members import run_with_workers, set_ward_tags_for_member
+from ueil_tagger.metrics import timed_stage
+from ueil_tagger.types import Member, TaggingsSummary
+from ueil_tagger.wards import address_to_geocode, get_ward_id_to_uuid_map
+from ueil_tagger.wards import get_ward_taggings_snapshot, wards_for_addresses
+
+if TYPE_CHECKING:
+    from ueil_tagger.client import Client
+    from ueil_tagger.plan import PlanWriter
+    from ueil_tagger.types import PersonToTagsMap, Uuid, WardToTagMap
+    from ueil_tagger.wards import AddressWardMap
+
+
+MIRROR_PATH = STATE_DIR_PATH / "mirror.sqlite3"
+# How many mirrored members are geocoded and assigned to wards together.
+MIRROR_CHUNK_SIZE = 250
+# How many taggings the API returns per page, which decides whether it's
+# cheaper to reload every ward tagging, or just those of changed members.
+TAGGINGS_PER_PAGE = 25
+
+MIRROR_SCHEMA = """
+CREATE TABLE IF NOT EXISTS members (
+    uuid TEXT PRIMARY KEY,
+    address_lines TEXT,
+    city TEXT,
+    state TEXT,
+    zipcode INTEGER,
+    custom_field_ward INTEGER,
+    modified_date TEXT
+);
+CREATE TABLE IF NOT EXISTS ward_taggings (
+    uuid TEXT NOT NULL,
+    tag_uuid TEXT NOT NULL,
+    PRIMARY KEY (uuid, tag_uuid)
+);
+CREATE TABLE IF NOT EXISTS sync_state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+# A local copy of the fields of each member that are used to pick their
+# wards, and of their current ward taggings, so that everyone can be
+# re-tagged without paging through every person in the API.
+class MemberMirror:
+    path: Path
+    connection: sqlite3.Connection
+    lock: threading.Lock
+
+    def __init__(self, path: Path = MIRROR_PATH) -> None:
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            # Commits are cheap in WAL mode, so taggings can be saved as
+            # each member is updated.
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.executescript(MIRROR_SCHEMA)
+
+    def __enter__(self) -> MemberMirror:
+        return self
+
+    def __exit__(self, exc_type: Optional[type[BaseException]],
+                 exc_value: Optional[BaseException],
+                 traceback: Optional[TracebackType]) -> None:
+        self.close()
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+    def synced_at(self) -> Optional[datetime]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value FROM sync_state WHERE key = 'synced_at'"
+            ).fetchone()
+        if not row:
+            return None
+        return datetime.fromisoformat(row[0])
+
+    def set_synced_at(self, synced_at: datetime) -> None:
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO sync_state VALUES ('synced_at', ?)",
+                (synced_at.isoformat(),))
+
+    @timed_stage("mirror save members")
+    def save_members(self, members: list[Member]) -> None:
+        rows = [(member.identifier,
+                 json.dumps(member.address_lines)
+                 if member.address_lines is not None else None,
+                 member.city, member.state, member.zipcode,
+                 member.custom_field_ward, member.modified_date)
+                for member in members]
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO members VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows)
+
+    @timed_stage("mirror read members")
+    def members(self) -> list[Member]:
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT * FROM members ORDER BY uuid").fetchall()
+        return [Member(person_uuid,
+                       json.loads(address_lines)
+                       if address_lines is not None else None,
+                       city, state, zipcode, custom_field_ward, modified_date)
+                for (person_uuid, address_lines, city, state, zipcode,
+                     custom_field_ward, modified_date) in rows]
+
+    def num_members(self) -> int:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT COUNT(*) FROM members").fetchone()
+        return int(row[0])
+
+    def ward_taggings(self) -> PersonToTagsMap:
+        person_to_tags: PersonToTagsMap = {}
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT uuid, tag_uuid FROM ward_taggings").fetchall()
+        for person_uuid, tag_uuid in rows:
+            person_to_tags.setdefault(person_uuid, set()).add(tag_uuid)
+        return person_to_tags
+
+    @timed_stage("mirror save taggings")
+    def set_ward_taggings(self, person_uuid: Uuid,
+                          tag_uuids: set[Uuid]) -> None:
+        with self.lock, self.connection:
+            self.connection.execute(
+                "DELETE FROM ward_taggings WHERE uuid = ?", (person_uuid,))
+            self.connection.executemany(
+                "INSERT INTO ward_taggings VALUES (?, ?)",
+                [(person_uuid, tag_uuid) for tag_uuid in sorted(tag_uuids)])
+
+    @timed_stage("mirror save taggings")
+    def replace_ward_taggings(self, person_to_tags: PersonToTagsMap) -> None:
+        rows = [(person_uuid, tag_uuid)
+                for person_uuid, tag_uuids in sorted(person_to_tags.items())
+                for tag_uuid in sorted(tag_uuids)]
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM ward_taggings")
+            self.connection.executemany(
+                "INSERT INTO ward_taggings VALUES (?, ?)", rows)
+
+
+# Copies everyone updated since the last sync (or everyone, on the first
+# sync) into the mirror, along with their ward taggings, and returns how
+# many people were copied.
+def sync_mirror(client: Client, mirror: MemberMirror, workers: int = 1,
+                prefetch_pages: int = 2) -> int:
+    started_at = datetime.now(timezone.utc)
+    since = mirror.synced_at()
+    if since:
+        logging.info("Syncing members updated since %s into the mirror",
+                     since.isoformat())
+    else:
+        logging.info("Copying all members into the mirror")
+
+    ward_to_tag_map = get_ward_id_to_uuid_map(client)
+    changed_members: list[Member] = []
+    for page_index, members in iter_member_pages(client, since,
+                                                 prefetch_pages):
+        mirror.save_members(members)
+        changed_members += members
+        logging.info("Copied %s members from page %s", len(members),
+                     page_index)
+
+    # Each person's taggings take a request, and each page of every ward
+    # tag's taggings takes one, so use whichever takes fewer.
+    num_members = mirror.num_members()
+    if not since or len(changed_members) * TAGGINGS_PER_PAGE > num_members:
+        logging.info("Loading current ward taggings for all people")
+        mirror.replace_ward_taggings(
+            get_ward_taggings_snapshot(client, ward_to_tag_map))
+    else:
+        logging.info("Loading current ward taggings for %s people",
+                     len(changed_members))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            tag_uuids_for_members = executor.map(
+                lambda member: get_ward_taggings_for_member(
+                    client, member, ward_to_tag_map),
+                changed_members)
+            for member, tag_uuids in zip(changed_members,
+                                         tag_uuids_for_members):
+                mirror.set_ward_taggings(member.identifier, tag_uuids)
+
+    mirror.set_synced_at(started_at)
+    logging.info("Synced %s members, %s in the mirror", len(changed_members),
+                 num_members)
+    return len(changed_members)
+
+
+def set_ward_tags_for_mirrored_member(
+        client: Client, mirror: MemberMirror, member: Member, min_sqft: int,
+        ward_to_tag_map: WardToTagMap, address_wards: AddressWardMap,
+        ward_taggings: PersonToTagsMap, incremental: bool,
+        plan_writer: Optional[PlanWriter]) -> TaggingsSummary:
+    tag_uuids = ward_taggings.get(member.identifier, set())
+    summary = set_ward_tags_for_member(
+        client, member, min_sqft, ward_to_tag_map, None, address_wards,
+        ward_taggings, incremental, plan_writer)
+    if ward_taggings.get(member.identifier, set()) != tag_uuids:
+        mirror.set_ward_taggings(member.identifier,
+                                 ward_taggings[member.identifier])
+    return summary
+
+
+# Re-tags everyone in the mirror, using the mirrored taggings to work out
+# what needs to change, so that only the changes are sent to the API.
+def set_ward_tags_for_mirrored_members(
+        client: Client, mirror: MemberMirror, min_sqft: int,
+        workers: int = 1, incremental: bool = False,
+        plan_writer: Optional[PlanWriter] = None) -> TaggingsSummary:
+    summary = TaggingsSummary()
+    members = mirror.members()
+    if not members:
+        logging.error("The mirror is empty, so there's no one to update "
+                      "(use --sync to fill it)")
+        summary.error_count += 1
+        return summary
+    logging.info("Tagging %s members from the mirror, last synced at %s",
+                 len(members), mirror.synced_at())
+
+    ward_to_tag_map = get_ward_id_to_uuid_map(client)
+    ward_taggings = mirror.ward_taggings()
+
+    # Each chunk of members is assigned to wards just before its members
+    # are handed to the workers (who geocode any addresses that haven't
+    # been geocoded yet).
+    def members_to_update() -> Iterator[tuple[Member, AddressWardMap]]:
+        for chunk_start in range(0, len(members), MIRROR_CHUNK_SIZE):
+            chunk = []
+            for member in members[chunk_start:
+                                  chunk_start + MIRROR_CHUNK_SIZE]:
+                if incremental and member_is_unchanged(member, min_sqft):
+                    summary.members_skipped += 1
+                    continue
+                chunk.append(member)
+
+            addresses = []
+            for member in chunk:
+                address = address_to_geocode(member)
+                if address:
+                    addresses.append(address)
+            address_wards = wards_for_addresses(addresses, cached_only=True)
+            for member in chunk:
+                yield member, address_wards
+
+    def update(item: tuple[Member, AddressWardMap]) -> TaggingsSummary:
+        member, address_wards = item
+        return set_ward_tags_for_mirrored_member(
+            client, mirror, member, min_sqft, ward_to_tag_map,
+            address_wards, ward_taggings, incremental, plan_writer)
+
+    run_with_workers(update, members_to_update(), summary.merge, workers)
+    logging.info("Updated %s members from the mirror", len(members))
+    return summary
@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import json
+import logging
+from pathlib import Path
+import threading
+from typing import Iterator, TextIO, TYPE_CHECKING
+
+from ueil_tagger.members import apply_member_tag_plan, run_with_workers
+from ueil_tagger.types import MemberTagPlan, TaggingsSummary
+
+if TYPE_CHECKING:
+    from ueil_tagger.client import Client
+
+
+# Plan files are JSON lines files, with one line for each member whose
+# taggings need to change, followed by a line with the summary of the run
+# that computed the plan.
+class PlanWriter:
+    path: Path
+    handle: TextIO
+    lock: threading.Lock
+    num_plans: int
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.handle = path.open("w")
+        self.lock = threading.Lock()
+        self.num_plans = 0
+
+    def write(self, plan: MemberTagPlan) -> None:
+        if plan.is_empty():
+            return
+        with self.lock:
+            self.handle.write(plan.to_json() + "\n")
+            self.num_plans += 1
+
+    def close(self, summary: TaggingsSummary) -> None:
+        with self.lock:
+            self.handle.write(json.dumps({"summary": summary.to_dict()}))
+            self.handle.write("\n")
+            self.handle.close()
+
+
+def read_plan(path: Path) -> Iterator[MemberTagPlan]:
+    with path.open() as handle:
+        for line in handle:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if "summary" in record:
+                continue
+            yield MemberTagPlan(**record)
+
+
+def failed_plan_path(path: Path) -> Path:
+    return path.with_name(f"{path.stem}.failed{path.suffix}")
+
+
+def apply_tag_plan(
+        client: Client, plan: MemberTagPlan) -> tuple[MemberTagPlan,
+                                                      TaggingsSummary]:
+    summary = TaggingsSummary()
+    try:
+        failed_plan = apply_member_tag_plan(client, plan, summary)
+    except Exception as e:
+        logging.error("person=%s: unable to apply plan: %s", plan.person, e)
+        summary.error_count += 1
+        failed_plan = plan
+    return failed_plan, summary
+
+
+def apply_plan(client: Client, path: Path,
+               workers: int = 1) -> TaggingsSummary:
+    summary = TaggingsSummary()
+    failed_path = failed_plan_path(path)
+    failed_writer = PlanWriter(failed_path)
+    logging.info("Applying plan '%s' using %s worker(s)", path, workers)
+
+    def finish(result: tuple[MemberTagPlan, TaggingsSummary]) -> None:
+        failed_plan, plan_summary = result
+        summary.merge(plan_summary)
+        failed_writer.write(failed_plan)
+
+    run_with_workers(lambda plan: apply_tag_plan(client, plan),
+                     read_plan(path), finish, workers)
+
+    failed_writer.close(summary)
+    if failed_writer.num_plans == 0:
+        failed_path.unlink()
+    else:
+        logging.error("Unable to apply the plan for %s members, written to "
+                      "'%s'", failed_writer.num_plans, failed_path)
+    return summary
@@ -0,0 +1,173 @@
+from __future__ import annotations
+
+import cProfile
+from pathlib import Path
+import pstats
+import re
+import sys
+import threading
+from types import FrameType
+from typing import Any, Optional, Protocol, TextIO
+
+from ueil_tagger.tracing import get_tracer
+
+
+# How often the sampling profiler records the stack of every thread.
+SAMPLE_INTERVAL_SECS = 0.005
+# How many functions or stacks are printed when no output path is given.
+NUM_REPORT_LINES = 30
+
+
+class RunProfiler(Protocol):
+    def start(self) -> None:
+        ...
+
+    def stop(self) -> None:
+        ...
+
+    def write(self, path: Path) -> None:
+        ...
+
+    def report(self, stream: TextIO) -> None:
+        ...
+
+
+# Profiles every function call, in every thread started after the
+# profiler, and writes the results as a pstats file (e.g., for snakeviz or
+# 'python -m pstats').
+class CallProfiler:
+    profiles: list[cProfile.Profile]
+    lock: threading.Lock
+    stats: Optional[pstats.Stats]
+
+    def __init__(self) -> None:
+        self.profiles = []
+        self.lock = threading.Lock()
+        self.stats = None
+
+    def __profile_thread(self, frame: FrameType, event: str,
+                         arg: Any) -> None:
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Newer Pythons only allow a single profiler, which already
+            # covers every thread.
+            return
+        with self.lock:
+            self.profiles.append(profile)
+
+    def start(self) -> None:
+        profile = cProfile.Profile()
+        self.profiles.append(profile)
+        threading.setprofile(self.__profile_thread)
+        profile.enable()
+
+    def stop(self) -> None:
+        threading.setprofile(None)
+        with self.lock:
+            main_profile, *thread_profiles = self.profiles
+            main_profile.disable()
+            self.stats = pstats.Stats(main_profile)
+            for profile in thread_profiles:
+                self.stats.add(profile)
+
+    def write(self, path: Path) -> None:
+        assert self.stats
+        self.stats.dump_stats(path)
+
+    def report(self, stream: TextIO) -> None:
+        assert self.stats
+        self.stats.stream = stream  # type: ignore[attr-defined]
+        self.stats.sort_stats("cumulative").print_stats(NUM_REPORT_LINES)
+
+
+def frame_label(frame: FrameType) -> str:
+    code = frame.f_code
+    file_name = Path(code.co_filename).name
+    return f"{code.co_name} ({file_name}:{code.co_firstlineno})"
+
+
+# Records the stack of every thread every few milliseconds, and writes
+# them as collapsed stacks (one line per distinct stack, with the number of
+# times it was seen), which flame graph tools can read. Threads in a pool
+# are counted together, under the pool's name.
+class SamplingProfiler:
+    interval: float
+    counts: dict[str, int]
+    stop_event: threading.Event
+    thread: Optional[threading.Thread]
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL_SECS) -> None:
+        self.interval = interval
+        self.counts = {}
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def __sample(self) -> None:
+        sampler_id = threading.get_ident()
+        thread_names = {t.ident: re.sub(r"_\d+$", "", t.name)
+                        for t in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == sampler_id:
+                continue
+            labels = []
+            current_frame: Optional[FrameType] = frame
+            while current_frame:
+                labels.append(frame_label(current_frame))
+                current_frame = current_frame.f_back
+            labels.append(thread_names.get(thread_id, "thread"))
+            stack = ";".join(reversed(labels))
+            self.counts[stack] = self.counts.get(stack, 0) + 1
+
+    def __run(self) -> None:
+        while not self.stop_event.wait(self.interval):
+            self.__sample()
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self.__run, daemon=True,
+                                       name="sampling-profiler")
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+
+    def write(self, path: Path) -> None:
+        with path.open("w") as handle:
+            for stack, count in sorted(self.counts.items()):
+                handle.write(f"{stack} {count}\n")
+
+    def report(self, stream: TextIO) -> None:
+        stacks = sorted(self.counts.items(), key=lambda s: s[1],
+                        reverse=True)
+        # Only the innermost few frames of each stack are printed.
+        for stack, count in stacks[:NUM_REPORT_LINES]:
+            innermost_frames = ";".join(stack.split(";")[-3:])
+            stream.write(f"{count:8} {innermost_frames}\n")
+
+
+def get_profiler(kind: str) -> RunProfiler:
+    if kind == "sample":
+        return SamplingProfiler()
+    return CallProfiler()
+
+
+# Spans are written next to the profile, to '<path>.spans'.
+def spans_path(path: Path) -> Path:
+    return path.with_name(path.name + ".spans")
+
+
+def write_profile(profiler: RunProfiler, path: Optional[Path]) -> None:
+    spans = get_tracer().collapsed_stacks()
+    if not path:
+        profiler.report(sys.stderr)
+        sys.stderr.write("\nSlowest spans (microseconds):\n")
+        for span_path, micros in spans[:NUM_REPORT_LINES]:
+            sys.stderr.write(f"{micros:12} {span_path}\n")
+        return
+    profiler.write(path)
+    with spans_path(path).open("w") as handle:
+        for span_path, micros in sorted(spans):
+            handle.write(f"{span_path} {micros}\n")
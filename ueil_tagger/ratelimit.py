@@ -0,0 +1,38 @@
+from __future__ import annotations
+
+import threading
+import time
+from typing import Optional
+
+
+# Token bucket limiter, meant to be shared between every thread that makes
+# requests against the same service.
+class RateLimiter:
+    rate: float
+    capacity: float
+    tokens: float
+    last_refill: float
+    lock: threading.Lock
+
+    def __init__(self, rate: float, burst: Optional[float] = None) -> None:
+        if rate <= 0:
+            raise ValueError(f"Rate must be positive, received {rate}")
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(rate, 1.0)
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                elapsed = now - self.last_refill
+                self.tokens = min(self.capacity,
+                                  self.tokens + elapsed * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_secs = (1 - self.tokens) / self.rate
+            time.sleep(wait_secs)
@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+from dataclasses import asdict, dataclass
+from datetime import datetime
+import json
+import os
+from pathlib import Path
+from typing import Optional
+
+from ueil_tagger import STATE_DIR_PATH
+from ueil_tagger.types import Shard, TaggingsSummary
+
+
+SHARD_RESULTS_DIR_PATH = STATE_DIR_PATH / "shards"
+
+
+# Written by each shard once it has finished updating all of its members.
+@dataclass
+class ShardResult:
+    shard: str
+    since: Optional[str]
+    started_at: str
+    finished_at: str
+    summary: dict[str, object]
+    # Given to every shard of the same run, so that results left from
+    # other runs aren't merged with them.
+    run_id: Optional[str] = None
+
+    def save(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_suffix(".tmp")
+        temp_path.write_text(json.dumps(asdict(self)))
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: Path) -> ShardResult:
+        return cls(**json.loads(path.read_text()))
+
+
+def shard_result_path(shard: Shard) -> Path:
+    return SHARD_RESULTS_DIR_PATH / f"{shard.name}.json"
+
+
+def find_shard_results() -> list[Path]:
+    return sorted(SHARD_RESULTS_DIR_PATH.glob("*.json"))
+
+
+# Removes the results of a run once they've been merged, so that they
+# aren't picked up by the next run's merge.
+def remove_shard_results(paths: list[Path]) -> None:
+    for path in paths:
+        path.unlink(missing_ok=True)
+
+
+# Combines the results of every shard of a run into one summary, and
+# returns it with the time the first shard started (which is when the next
+# run needs to look for updated members from). Raises a ValueError unless
+# there is exactly one result for each shard, all from the same run.
+def merge_shard_results(
+        results: list[ShardResult]) -> tuple[TaggingsSummary, datetime]:
+    if not results:
+        raise ValueError("No shard results to merge")
+    shards = [Shard.parse(result.shard) for result in results]
+    num_shards = shards[0].count
+    if any(shard.count != num_shards for shard in shards):
+        raise ValueError("Shard results are from runs split into different "
+                         "numbers of shards")
+    indexes = sorted(shard.index for shard in shards)
+    if indexes != list(range(num_shards)):
+        missing = sorted(set(range(num_shards)) - set(indexes))
+        raise ValueError(f"Expected one result for each of {num_shards} "
+                         f"shards, missing shards {missing}, found "
+                         f"{len(indexes)} results")
+    if len({result.run_id for result in results}) != 1:
+        raise ValueError("Shard results are from runs with different "
+                         "--run-id values")
+    if len({result.since for result in results}) != 1:
+        raise ValueError("Shard results are from runs with different "
+                         "--since dates")
+
+    summary = TaggingsSummary()
+    for result in results:
+        summary.merge(TaggingsSummary.from_dict(result.summary))
+    started_at = min(datetime.fromisoformat(result.started_at)
+                     for result in results)
+    return summary, started_at
@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+from contextlib import AbstractContextManager, contextmanager
+from dataclasses import dataclass
+import functools
+import threading
+import time
+from typing import Callable, Iterator, ParamSpec, TypeVar
+
+
+P = ParamSpec("P")
+R = TypeVar("R")
+
+
+@dataclass
+class OpenSpan:
+    path: str
+    start_time: float
+    child_secs: float = 0.0
+
+
+# Records how long is spent in each nested span, in each thread, as
+# "collapsed stacks" (e.g., "member plan;wards_for_member;geocode 1200",
+# with the time spent in that span itself, in microseconds), which flame
+# graph tools can read. Spans are only recorded once tracing is enabled.
+class Tracer:
+    enabled: bool
+    lock: threading.Lock
+    local: threading.local
+    self_secs: dict[str, float]
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.self_secs = {}
+
+    def enable(self) -> None:
+        self.enabled = True
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        if not self.enabled:
+            yield
+            return
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        stack: list[OpenSpan] = self.local.stack
+        path = f"{stack[-1].path};{name}" if stack else name
+        open_span = OpenSpan(path, time.perf_counter())
+        stack.append(open_span)
+        try:
+            yield
+        finally:
+            stack.pop()
+            elapsed_secs = time.perf_counter() - open_span.start_time
+            if stack:
+                stack[-1].child_secs += elapsed_secs
+            with self.lock:
+                self.self_secs[path] = (self.self_secs.get(path, 0.0) +
+                                        elapsed_secs - open_span.child_secs)
+
+    def collapsed_stacks(self) -> list[tuple[str, int]]:
+        with self.lock:
+            stacks = [(path, round(secs * 1_000_000))
+                      for path, secs in self.self_secs.items()]
+        return sorted(stacks, key=lambda stack: stack[1], reverse=True)
+
+
+@functools.cache
+def get_tracer() -> Tracer:
+    return Tracer()
+
+
+def span(name: str) -> AbstractContextManager[None]:
+    return get_tracer().span(name)
+
+
+def traced(name: str) -> Callable[[Callable[P, R]], Callable[P, R]]:
+    def decorator(func: Callable[P, R]) -> Callable[P, R]:
+        @functools.wraps(func)
+        def wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
+            with get_tracer().span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,7 +1,11 @@
+from __future__ import annotations
+
+from bisect import bisect_left
 from enum import Enum, auto
-from dataclasses import dataclass
+from dataclasses import asdict, dataclass, field, fields
+import hashlib
 import json
-from typing import Any, Optional
+from typing import Any, Mapping, Optional
 
 
 @dataclass
@@ -18,9 +22,13 @@ ZipCode = int
 StreetAddress = str
 LatLong = tuple[float, float]
 
-WardZipData = dict[ZipCode, list[tuple[WardNum, float]]]
+# Value used in ward number arrays for points that don't fall in any ward.
+NO_WARD = 0
+
+WardZipData = Mapping[ZipCode, tuple[tuple[WardNum, float], ...]]
 WardToTagMap = dict[WardNum, Uuid]
-SigWardZipData = dict[ZipCode, list[WardNum]]
+PersonToTagsMap = dict[Uuid, set[Uuid]]
+SigWardZipData = Mapping[ZipCode, tuple[WardNum, ...]]
 
 
 class WardTaggingStrategy(Enum):
@@ -29,34 +37,250 @@ class WardTaggingStrategy(Enum):
     ZIPCODE = auto()
 
 
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    size: int = 0
+
+    def merge(self, other: CacheStats) -> None:
+        self.hits += other.hits
+        self.misses += other.misses
+        self.size = max(self.size, other.size)
+
+    def to_dict(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": self.size
+        }
+
+
+# How the limit on API requests in flight at once was adjusted during a
+# run (see ConcurrencyLimiter), or all zeros if it wasn't adjusted.
+@dataclass
+class ConcurrencyStats:
+    # The limit at the end of the run, and the lowest and highest it was.
+    limit: int = 0
+    min_limit: int = 0
+    max_limit: int = 0
+    increases: int = 0
+    # Times the limit was lowered after a 429 response or a timeout.
+    throttle_events: int = 0
+    # Times the limit was lowered because requests were getting slower.
+    latency_events: int = 0
+    # Times the limit was lowered because too many requests failed.
+    error_events: int = 0
+
+    def merge(self, other: ConcurrencyStats) -> None:
+        self.limit = max(self.limit, other.limit)
+        self.min_limit = min((limit for limit in (self.min_limit,
+                                                  other.min_limit) if limit),
+                             default=0)
+        self.max_limit = max(self.max_limit, other.max_limit)
+        self.increases += other.increases
+        self.throttle_events += other.throttle_events
+        self.latency_events += other.latency_events
+        self.error_events += other.error_events
+
+    def to_dict(self) -> dict[str, int]:
+        return {
+            "limit": self.limit,
+            "min limit": self.min_limit,
+            "max limit": self.max_limit,
+            "increases": self.increases,
+            "throttle events": self.throttle_events,
+            "latency events": self.latency_events,
+            "error events": self.error_events
+        }
+
+
+# Upper bounds (in seconds) of the buckets that stage latencies are counted
+# in. Latencies above the last bound are counted in an extra bucket.
+LATENCY_BUCKETS_SECS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                        0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def empty_latency_histogram() -> list[int]:
+    return [0] * (len(LATENCY_BUCKETS_SECS) + 1)
+
+
+@dataclass
+class StageStats:
+    count: int = 0
+    total_secs: float = 0.0
+    num_bytes: int = 0
+    retries: int = 0
+    errors: int = 0
+    histogram: list[int] = field(default_factory=empty_latency_histogram)
+
+    def observe(self, secs: float, num_bytes: int = 0, retries: int = 0,
+                error: bool = False) -> None:
+        self.count += 1
+        self.total_secs += secs
+        self.num_bytes += num_bytes
+        self.retries += retries
+        self.errors += int(error)
+        self.histogram[bisect_left(LATENCY_BUCKETS_SECS, secs)] += 1
+
+    def merge(self, other: StageStats) -> None:
+        self.count += other.count
+        self.total_secs += other.total_secs
+        self.num_bytes += other.num_bytes
+        self.retries += other.retries
+        self.errors += other.errors
+        for index, bucket_count in enumerate(other.histogram):
+            self.histogram[index] += bucket_count
+
+    def to_dict(self) -> dict[str, Any]:
+        bucket_names = [str(b) for b in LATENCY_BUCKETS_SECS] + ["+Inf"]
+        return {
+            "count": self.count,
+            "total secs": round(self.total_secs, 6),
+            "bytes": self.num_bytes,
+            "retries": self.retries,
+            "errors": self.errors,
+            "latency histogram": dict(zip(bucket_names, self.histogram))
+        }
+
+
+# Counts, timings, bytes transferred and retries for each stage of a run
+# (e.g., each kind of API request, geocoding, ward lookups and cache reads
+# and writes), by stage name.
+@dataclass
+class StageMetrics:
+    stages: dict[str, StageStats] = field(default_factory=dict)
+
+    def stage(self, name: str) -> StageStats:
+        if name not in self.stages:
+            self.stages[name] = StageStats()
+        return self.stages[name]
+
+    def merge(self, other: StageMetrics) -> None:
+        for name, stats in other.stages.items():
+            self.stage(name).merge(stats)
+
+    def to_dict(self) -> dict[str, Any]:
+        return {name: self.stages[name].to_dict()
+                for name in sorted(self.stages)}
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> StageMetrics:
+        return cls({name: StageStats(**stats)
+                    for name, stats in data.get("stages", {}).items()})
+
+
 @dataclass
 class TaggingsSummary:
     taggings_deleted: int = 0
     taggings_added: int = 0
     members_modified: int = 0
+    members_unchanged: int = 0
+    members_skipped: int = 0
     members_tagged_from_field: int = 0
     members_tagged_from_address: int = 0
     members_tagged_from_zipcode: int = 0
     members_not_tagged: int = 0
     error_count: int = 0
+    address_cache: CacheStats = field(default_factory=CacheStats)
+    metrics: StageMetrics = field(default_factory=StageMetrics)
+    concurrency: ConcurrencyStats = field(default_factory=ConcurrencyStats)
 
     def to_json(self) -> str:
         summary = {
             "taggings deleted": self.taggings_deleted,
             "taggings added": self.taggings_added,
             "members modified": self.members_modified,
+            "members unchanged": self.members_unchanged,
+            "members skipped": self.members_skipped,
             "members tagged from field": self.members_tagged_from_field,
             "members tagged from address": self.members_tagged_from_address,
             "members tagged from zipcode": self.members_tagged_from_zipcode,
             "members not tagged": self.members_not_tagged,
-            "errors": self.error_count
+            "errors": self.error_count,
+            "address cache": self.address_cache.to_dict(),
+            "concurrency": self.concurrency.to_dict(),
+            "stages": self.metrics.to_dict()
         }
         return json.dumps(summary)
 
+    def to_dict(self) -> dict[str, Any]:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> TaggingsSummary:
+        summary_data = dict(data)
+        address_cache = CacheStats(**summary_data.pop("address_cache", {}))
+        metrics = StageMetrics.from_dict(summary_data.pop("metrics", {}))
+        concurrency = ConcurrencyStats(**summary_data.pop("concurrency", {}))
+        return cls(**summary_data, address_cache=address_cache,
+                   metrics=metrics, concurrency=concurrency)
+
+    def merge(self, other: TaggingsSummary) -> None:
+        for summary_field in fields(self):
+            value = getattr(self, summary_field.name)
+            other_value = getattr(other, summary_field.name)
+            if isinstance(value, int):
+                setattr(self, summary_field.name, value + other_value)
+            else:
+                value.merge(other_value)
+
     def encountered_error(self) -> bool:
         return self.error_count > 0
 
 
+# The changes needed to make a member's ward taggings match their wards.
+@dataclass
+class MemberTagPlan:
+    person: Uuid
+    wards: list[WardNum]
+    add_tags: list[Uuid]
+    remove_tags: list[Uuid]
+
+    def is_empty(self) -> bool:
+        return not self.add_tags and not self.remove_tags
+
+    def to_json(self) -> str:
+        return json.dumps(asdict(self))
+
+
+# One of several runs (e.g., on different hosts) that together update
+# every member, each updating the members whose uuids hash to its index.
+@dataclass(frozen=True)
+class Shard:
+    index: int
+    count: int
+
+    @classmethod
+    def parse(cls, text: str) -> Shard:
+        index_text, _, count_text = text.partition("/")
+        index, count = int(index_text), int(count_text)
+        if count < 1 or not 0 <= index < count:
+            raise ValueError(f"Invalid shard '{text}'")
+        return cls(index, count)
+
+    @property
+    def name(self) -> str:
+        return f"{self.index}-of-{self.count}"
+
+    def __str__(self) -> str:
+        return f"{self.index}/{self.count}"
+
+    def contains(self, member_uuid: Uuid) -> bool:
+        digest = hashlib.sha256(member_uuid.encode()).digest()
+        return int.from_bytes(digest[:8], "big") % self.count == self.index
+
+
+# What was last computed for a member, so that members whose address
+# and ward fields haven't changed (and with the same ward data) can be
+# skipped.
+@dataclass
+class MemberFingerprint:
+    fingerprint: str
+    wards: list[WardNum]
+    ward_data_version: str
+
+
 @dataclass
 class Member:
     identifier: Uuid
@@ -65,6 +289,8 @@ class Member:
     state: Optional[str]
     zipcode: Optional[int]
     custom_field_ward: Optional[int]
+    # When the person's record was last changed, as given by the API.
+    modified_date: Optional[str] = None
 
     def has_street_address(self) -> bool:
         if self.address_lines is None:
@@ -89,3 +315,9 @@ class Member:
         if len(address_str) > 0:
             return address_str
         return None
+
+    def fingerprint(self) -> str:
+        ward_fields = [self.address_lines, self.city, self.state,
+                       self.zipcode, self.custom_field_ward]
+        ward_fields_json = json.dumps(ward_fields).encode("utf8")
+        return hashlib.sha256(ward_fields_json).hexdigest()
@@ -0,0 +1,187 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+import functools
+import hashlib
+import json
+import logging
+import mmap
+import os
+from pathlib import Path
+import struct
+from types import MappingProxyType
+from typing import Any, cast, Optional, TYPE_CHECKING
+
+import numpy as np
+import shapely
+import shapely.errors
+import shapely.wkt
+
+from ueil_tagger import DATA_DIR_PATH, STATE_DIR_PATH
+from ueil_tagger.ward_grid import build_ward_grid, WardGrid
+
+if TYPE_CHECKING:
+    from shapely import MultiPolygon
+    from ueil_tagger.types import WardNum, WardZipData
+
+
+WARDS_SOURCE_PATH = DATA_DIR_PATH / "wards.json"
+ZIPCODE_SOURCE_PATH = DATA_DIR_PATH / "zipcode_to_wards.json"
+COMPILED_DATA_PATH = STATE_DIR_PATH / "ward_data.bin"
+
+# The compiled file is laid out as a fixed size preamble (magic bytes,
+# format version, and the length of the JSON header), then the JSON header
+# itself, and then the WKB encoded ward shapes and the ward lookup grid,
+# which the header points into with (offset, length) pairs relative to the
+# end of the header.
+COMPILED_MAGIC = b"UEILWARD"
+COMPILED_FORMAT_VERSION = 2
+COMPILED_PREAMBLE = struct.Struct("<8sII")
+
+
+@dataclass
+class WardData:
+    source_hash: str
+    ward_shapes: list[tuple[WardNum, MultiPolygon]]
+    wards_for_zip: WardZipData
+    # The grid is only built when compiling the ward data, since it takes
+    # a few seconds to build.
+    grid: Optional[WardGrid] = None
+
+
+def source_data_hash(wards_path: Path = WARDS_SOURCE_PATH,
+                     zipcode_path: Path = ZIPCODE_SOURCE_PATH) -> str:
+    hasher = hashlib.sha256()
+    for source_path in (wards_path, zipcode_path):
+        hasher.update(source_path.read_bytes())
+    return hasher.hexdigest()
+
+
+def wards_for_zip_from_json(zip_records: dict[str, Any]) -> WardZipData:
+    wards_for_zip = {}
+    for zipcode, ward_records in zip_records.items():
+        wards = tuple((int(ward), float(sqft)) for ward, sqft in ward_records)
+        wards_for_zip[int(zipcode)] = wards
+    return MappingProxyType(wards_for_zip)
+
+
+def parse_source_ward_data(
+        wards_path: Path = WARDS_SOURCE_PATH,
+        zipcode_path: Path = ZIPCODE_SOURCE_PATH) -> WardData:
+    source_hash = source_data_hash(wards_path, zipcode_path)
+
+    ward_records = json.loads(wards_path.read_text())
+    ward_shapes = []
+    for ward_number, ward_shape_text in ward_records:
+        ward_shape = cast("MultiPolygon", shapely.wkt.loads(ward_shape_text))
+        ward_shapes.append((int(ward_number), ward_shape))
+
+    zip_records = json.loads(zipcode_path.read_text())
+    wards_for_zip = wards_for_zip_from_json(zip_records)
+    return WardData(source_hash, ward_shapes, wards_for_zip)
+
+
+def compile_ward_data(
+        output_path: Path = COMPILED_DATA_PATH) -> WardData:
+    logging.info("Compiling ward data to '%s'", output_path)
+    ward_data = parse_source_ward_data()
+    logging.info("Building ward lookup grid")
+    grid = build_ward_grid(ward_data.ward_shapes)
+    ward_data.grid = grid
+
+    ward_entries = []
+    ward_blobs = []
+    offset = 0
+    for ward_number, ward_shape in ward_data.ward_shapes:
+        blob = shapely.to_wkb(ward_shape)
+        ward_entries.append([ward_number, offset, len(blob)])
+        ward_blobs.append(blob)
+        offset += len(blob)
+    grid_blob = grid.cells.tobytes()
+    num_rows, num_cols = grid.cells.shape
+
+    header = {
+        "source_hash": ward_data.source_hash,
+        "wards": ward_entries,
+        "zips": {str(k): v for k, v in ward_data.wards_for_zip.items()},
+        "grid": {
+            "min_long": grid.min_long,
+            "min_lat": grid.min_lat,
+            "cell_size": grid.cell_size,
+            "rows": num_rows,
+            "cols": num_cols,
+            "offset": offset,
+            "length": len(grid_blob),
+        },
+    }
+    header_bytes = json.dumps(header).encode("utf8")
+    preamble = COMPILED_PREAMBLE.pack(COMPILED_MAGIC, COMPILED_FORMAT_VERSION,
+                                      len(header_bytes))
+
+    # Write to a temp file and then move it into place, so that a concurrent
+    # reader never sees a partially written file.
+    temp_path = output_path.with_suffix(".tmp")
+    with temp_path.open("wb") as handle:
+        handle.write(preamble)
+        handle.write(header_bytes)
+        for blob in ward_blobs:
+            handle.write(blob)
+        handle.write(grid_blob)
+    os.replace(temp_path, output_path)
+    return ward_data
+
+
+def read_compiled_ward_data(
+        source_hash: str,
+        input_path: Path = COMPILED_DATA_PATH) -> Optional[WardData]:
+    if not input_path.is_file():
+        return None
+    with input_path.open("rb") as handle:
+        with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if len(data) < COMPILED_PREAMBLE.size:
+                return None
+            magic, version, header_len = COMPILED_PREAMBLE.unpack_from(data)
+            if magic != COMPILED_MAGIC or version != COMPILED_FORMAT_VERSION:
+                return None
+            header_start = COMPILED_PREAMBLE.size
+            blobs_start = header_start + header_len
+            header = json.loads(data[header_start:blobs_start])
+            if header["source_hash"] != source_hash:
+                return None
+
+            ward_shapes = []
+            for ward_number, offset, length in header["wards"]:
+                blob_start = blobs_start + offset
+                blob = data[blob_start:blob_start + length]
+                ward_shape = cast("MultiPolygon", shapely.from_wkb(blob))
+                ward_shapes.append((ward_number, ward_shape))
+
+            grid_header = header["grid"]
+            grid_start = blobs_start + grid_header["offset"]
+            grid_blob = data[grid_start:grid_start + grid_header["length"]]
+            cells = np.frombuffer(grid_blob, dtype=np.int8).reshape(
+                grid_header["rows"], grid_header["cols"])
+            grid = WardGrid(grid_header["min_long"], grid_header["min_lat"],
+                            grid_header["cell_size"], cells)
+
+    wards_for_zip = wards_for_zip_from_json(header["zips"])
+    return WardData(source_hash, ward_shapes, wards_for_zip, grid)
+
+
+@functools.cache
+def get_ward_data() -> WardData:
+    source_hash = source_data_hash()
+    try:
+        ward_data = read_compiled_ward_data(source_hash)
+        if ward_data:
+            logging.debug("Loaded compiled ward data (hash=%s)", source_hash)
+            return ward_data
+    except (OSError, ValueError, shapely.errors.ShapelyError) as e:
+        logging.warning("Unable to read compiled ward data: %s", e)
+
+    logging.info("Compiled ward data is missing or out of date, rebuilding")
+    try:
+        return compile_ward_data()
+    except OSError as e:
+        logging.warning("Unable to write compiled ward data: %s", e)
+        return parse_source_ward_data()
@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+import math
+from typing import TYPE_CHECKING
+
+import numpy as np
+import numpy.typing as npt
+import shapely
+
+from ueil_tagger.types import NO_WARD
+
+if TYPE_CHECKING:
+    from shapely import MultiPolygon
+    from ueil_tagger.types import WardNum
+
+
+# Value of cells that overlap the edge of a ward, and so can't be resolved
+# without an exact point-in-polygon test.
+BOUNDARY_CELL = -1
+# Roughly 80m x 110m cells in Chicago.
+DEFAULT_CELL_SIZE = 0.001
+# Cells are classified starting from blocks of 2^n x 2^n cells, and only
+# the blocks that overlap a ward edge are split into smaller ones.
+NUM_BLOCK_LEVELS = 6
+# Cells are grown by this much (in degrees) when testing them against the
+# wards, so that points on the very edge of a cell are always covered.
+CELL_MARGIN = 1e-9
+
+
+@dataclass
+class WardGrid:
+    min_long: float
+    min_lat: float
+    cell_size: float
+    cells: npt.NDArray[np.int8]
+
+    def lookup(
+            self, long_lats: npt.NDArray[np.float64]) -> npt.NDArray[np.int8]:
+        results = np.full(len(long_lats), NO_WARD, dtype=np.int8)
+        if len(long_lats) == 0:
+            return results
+        num_rows, num_cols = self.cells.shape
+        cols = np.floor((long_lats[:, 0] - self.min_long) / self.cell_size)
+        rows = np.floor((long_lats[:, 1] - self.min_lat) / self.cell_size)
+        # Points outside the grid are outside every ward (the grid covers
+        # the bounding box of all the wards).
+        in_grid = ((cols >= 0) & (cols < num_cols) &
+                   (rows >= 0) & (rows < num_rows))
+        results[in_grid] = self.cells[rows[in_grid].astype(np.intp),
+                                      cols[in_grid].astype(np.intp)]
+        return results
+
+
+def build_ward_grid(ward_shapes: list[tuple[WardNum, MultiPolygon]],
+                    cell_size: float = DEFAULT_CELL_SIZE) -> WardGrid:
+    ward_nums = np.array([ward for ward, _ in ward_shapes], dtype=np.int8)
+    shapes = np.array([shape for _, shape in ward_shapes])
+    shapely.prepare(shapes)
+    tree = shapely.STRtree(shapes)
+
+    min_long, min_lat, max_long, max_lat = shapely.total_bounds(shapes)
+    num_cols = math.ceil((max_long - min_long) / cell_size)
+    num_rows = math.ceil((max_lat - min_lat) / cell_size)
+    cells = np.full((num_rows, num_cols), NO_WARD, dtype=np.int8)
+
+    block_size = 2 ** NUM_BLOCK_LEVELS
+    block_col_grid, block_row_grid = np.meshgrid(
+        np.arange(0, num_cols, block_size), np.arange(0, num_rows, block_size))
+    block_cols = block_col_grid.ravel()
+    block_rows = block_row_grid.ravel()
+    while len(block_rows) > 0:
+        block_degrees = block_size * cell_size
+        x0 = min_long + block_cols * cell_size - CELL_MARGIN
+        y0 = min_lat + block_rows * cell_size - CELL_MARGIN
+        x1 = x0 + block_degrees + 2 * CELL_MARGIN
+        y1 = y0 + block_degrees + 2 * CELL_MARGIN
+        boxes = shapely.box(x0, y0, x1, y1)
+
+        box_indexes, shape_indexes = tree.query(boxes, predicate="intersects")
+        inside = shapely.contains_properly(shapes[shape_indexes],
+                                           boxes[box_indexes])
+        for box_index, shape_index in zip(box_indexes[inside],
+                                          shape_indexes[inside]):
+            row = block_rows[box_index]
+            col = block_cols[box_index]
+            cells[row:row + block_size, col:col + block_size] = (
+                ward_nums[shape_index])
+
+        # Blocks that touch a ward, but aren't entirely inside one, are
+        # either split into four smaller blocks, or (once they're a single
+        # cell) marked as being on a boundary.
+        partial = np.zeros(len(boxes), dtype=bool)
+        partial[box_indexes] = True
+        partial[box_indexes[inside]] = False
+        partial_rows = block_rows[partial]
+        partial_cols = block_cols[partial]
+        if block_size == 1:
+            cells[partial_rows, partial_cols] = BOUNDARY_CELL
+            break
+
+        block_size //= 2
+        block_rows = np.concatenate([partial_rows, partial_rows,
+                                     partial_rows + block_size,
+                                     partial_rows + block_size])
+        block_cols = np.concatenate([partial_cols, partial_cols + block_size,
+                                     partial_cols, partial_cols + block_size])
+        in_grid = (block_rows < num_rows) & (block_cols < num_cols)
+        block_rows = block_rows[in_grid]
+        block_cols = block_cols[in_grid]
+
+    return WardGrid(float(min_long), float(min_lat), cell_size, cells)
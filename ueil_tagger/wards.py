@@ -1,23 +1,32 @@
 from __future__ import annotations
 
 from dataclasses import dataclass
+import functools
 import json
 import logging
 from pprint import pformat
-from typing import cast, Optional, TYPE_CHECKING
+from types import MappingProxyType
+from typing import Iterable, Mapping, Optional, TYPE_CHECKING
 
-from shapely import Point
-import shapely.wkt
+import numpy as np
+import numpy.typing as npt
+from shapely import STRtree
+import shapely
 
-from ueil_tagger import DATA_DIR_PATH
 from ueil_tagger.client import Client
-from ueil_tagger.geolocate import coords_for_address
-from ueil_tagger.types import Member, WardTaggingStrategy
+from ueil_tagger.geolocate import cached_coords_for_address, coords_for_address
+from ueil_tagger.metrics import timed_stage
+from ueil_tagger.tracing import traced
+from ueil_tagger.ward_data import get_ward_data
+from ueil_tagger.ward_grid import BOUNDARY_CELL, WardGrid
+from ueil_tagger.types import Member, NO_WARD, WardTaggingStrategy
 
 if TYPE_CHECKING:
     from shapely import MultiPolygon
+    from ueil_tagger.types import Coords
     from ueil_tagger.types import WardZipData, SigWardZipData, WardToTagMap
-    from ueil_tagger.types import WardNum
+    from ueil_tagger.types import PersonToTagsMap, StreetAddress, WardNum
+    AddressWardMap = Mapping[StreetAddress, Optional[WardNum]]
     WardLookupResult = Optional[tuple[list[WardNum], WardTaggingStrategy]]
 
 
@@ -28,53 +37,156 @@ class WardShape:
 
 
 def load_ward_data() -> list[WardShape]:
-    ward_data_path = DATA_DIR_PATH / "wards.json"
-    ward_records = json.loads(ward_data_path.read_text())
+    ward_data = get_ward_data()
+    return [WardShape(num, shape) for num, shape in ward_data.ward_shapes]
 
-    wards = []
-    for ward_number, ward_shape_text in ward_records:
-        ward_number = int(ward_number)
-        ward_shape = cast("MultiPolygon", shapely.wkt.loads(ward_shape_text))
-        ward = WardShape(ward_number, ward_shape)
-        wards.append(ward)
-    return wards
+
+class WardIndex:
+    wards: list[WardShape]
+    ward_nums: npt.NDArray[np.int64]
+    shapes: npt.NDArray[np.object_]
+    tree: STRtree
+    grid: Optional[WardGrid]
+
+    def __init__(self, wards: list[WardShape],
+                 grid: Optional[WardGrid] = None) -> None:
+        self.wards = wards
+        self.grid = grid
+        self.ward_nums = np.array([ward.ward for ward in wards],
+                                  dtype=np.int64)
+        self.shapes = np.array([ward.shape for ward in wards], dtype=object)
+        shapely.prepare(self.shapes)
+        self.tree = STRtree(self.shapes)
+
+    def lookup(self, coords: Coords) -> Optional[WardNum]:
+        long_lat = np.array([(coords.long, coords.lat)], dtype=np.float64)
+        ward_num = self.lookup_array(long_lat)[0]
+        return int(ward_num) if ward_num != NO_WARD else None
+
+    def lookup_many(self,
+                    coords_list: Iterable[Coords]) -> list[Optional[WardNum]]:
+        long_lats = [(coords.long, coords.lat) for coords in coords_list]
+        ward_nums = self.lookup_array(np.array(long_lats, dtype=np.float64))
+        return [int(ward) if ward != NO_WARD else None for ward in ward_nums]
+
+    def lookup_array(
+            self, long_lats: npt.NDArray[np.float64]) -> npt.NDArray[np.int64]:
+        if self.grid is None or len(long_lats) == 0:
+            return self.lookup_array_exact(long_lats)
+        # Most points fall in a grid cell that's entirely inside one ward,
+        # so only points in cells on a ward boundary need an exact test.
+        results = self.grid.lookup(long_lats).astype(np.int64)
+        on_boundary = results == BOUNDARY_CELL
+        if on_boundary.any():
+            results[on_boundary] = self.lookup_array_exact(
+                long_lats[on_boundary])
+        return results
+
+    def lookup_array_exact(
+            self, long_lats: npt.NDArray[np.float64]) -> npt.NDArray[np.int64]:
+        results = np.full(len(long_lats), NO_WARD, dtype=np.int64)
+        if len(long_lats) == 0:
+            return results
+        points = np.asarray(shapely.points(long_lats))
+        # Query by bounding box, and then test the candidates with the
+        # prepared ward shapes (a "within" predicate would prepare the
+        # points instead).
+        point_indexes, ward_indexes = self.tree.query(points)
+        inside = shapely.contains(self.shapes[ward_indexes],
+                                  points[point_indexes])
+        results[point_indexes[inside]] = self.ward_nums[ward_indexes[inside]]
+        return results
+
+
+@functools.cache
+def get_ward_index() -> WardIndex:
+    logging.debug("Building ward index")
+    return WardIndex(load_ward_data(), get_ward_data().grid)
 
 
 def load_wards_for_zip_data() -> WardZipData:
-    ward_data_path = DATA_DIR_PATH / "zipcode_to_wards.json"
-    data = json.loads(ward_data_path.read_text())
-    ward_zip_data: WardZipData = {}
-    for key, value in data.items():
-        ward_zip_data[int(key)] = value
-    return ward_zip_data
+    return get_ward_data().wards_for_zip
+
+
+@functools.cache
+def significant_wards_for_zip(min_ward_sqft: float) -> SigWardZipData:
+    return significant_wards(load_wards_for_zip_data(), min_ward_sqft)
 
 
-def significant_wards_for_zip(min_ward_sqft: int) -> SigWardZipData:
-    wards_for_zip = load_wards_for_zip_data()
-    sig_wards_for_zip: SigWardZipData = {}
+def significant_wards(wards_for_zip: WardZipData,
+                      min_ward_sqft: float) -> SigWardZipData:
+    sig_wards_for_zip = {}
     for zipcode, wards in wards_for_zip.items():
-        sig_wards_for_zip[zipcode] = []
-        for ward_num, sqft_overlap in wards:
-            if sqft_overlap >= min_ward_sqft:
-                sig_wards_for_zip[zipcode].append(ward_num)
-    return sig_wards_for_zip
+        sig_wards = tuple(ward_num for ward_num, sqft_overlap in wards
+                          if sqft_overlap >= min_ward_sqft)
+        sig_wards_for_zip[zipcode] = sig_wards
+    return MappingProxyType(sig_wards_for_zip)
+
+
+# Identifies the ward data and settings used to compute a member's wards,
+# so that stored results can be discarded when either changes. The sqft
+# is always formatted as a float, since it's an int when read from the
+# config file, but a float when given as --min-sqft.
+def ward_data_version(min_ward_sqft: float) -> str:
+    return f"{get_ward_data().source_hash}:{float(min_ward_sqft)!r}"
+
 
+@timed_stage("ward lookup batch")
+def wards_for_points(
+        long_lats: npt.NDArray[np.float64]) -> npt.NDArray[np.int64]:
+    return get_ward_index().lookup_array(long_lats)
 
+
+@timed_stage("ward lookup")
 def ward_for_address(address: str) -> Optional[WardNum]:
     coords = coords_for_address(address)
     if not coords:
         return None
-    point = Point(coords.long, coords.lat)
-    ward_data = load_ward_data()
-    for ward in ward_data:
-        if ward.shape.contains(point):
-            return ward.ward
-    return None
+    return get_ward_index().lookup(coords)
 
 
-def wards_for_member(member: Member,
-                     min_ward_sqft: int) -> WardLookupResult:
-    sig_wards_for_zip = significant_wards_for_zip(min_ward_sqft)
+# Assigns wards to addresses in a single pass. With cached_only, addresses
+# that haven't been geocoded yet are left out (rather than being geocoded
+# one at a time here), so that they're geocoded when they're looked up.
+def wards_for_addresses(addresses: Iterable[StreetAddress],
+                        cached_only: bool = False) -> AddressWardMap:
+    address_wards: dict[StreetAddress, Optional[WardNum]] = {}
+    geocoded_addresses: list[StreetAddress] = []
+    long_lats: list[tuple[float, float]] = []
+    for address in addresses:
+        if address in address_wards:
+            continue
+        if cached_only:
+            found, coords = cached_coords_for_address(address)
+            if not found:
+                continue
+        else:
+            coords = coords_for_address(address)
+        address_wards[address] = None
+        if not coords:
+            continue
+        geocoded_addresses.append(address)
+        long_lats.append((coords.long, coords.lat))
+
+    ward_nums = wards_for_points(np.array(long_lats, dtype=np.float64))
+    for address, ward_num in zip(geocoded_addresses, ward_nums):
+        if ward_num != NO_WARD:
+            address_wards[address] = int(ward_num)
+    return address_wards
+
+
+def address_to_geocode(member: Member) -> Optional[StreetAddress]:
+    if member.custom_field_ward:
+        return None
+    if not member.has_street_address():
+        return None
+    return member.full_address()
+
+
+@traced("wards_for_member")
+def wards_for_member(
+        member: Member, min_ward_sqft: int,
+        address_wards: Optional[AddressWardMap] = None) -> WardLookupResult:
     ward: int | None = None
     if member.custom_field_ward:
         ward = member.custom_field_ward
@@ -84,7 +196,10 @@ def wards_for_member(member: Member,
     if member.has_street_address():
         member_address = member.full_address()
         if member_address:
-            ward = ward_for_address(member_address)
+            if address_wards is not None and member_address in address_wards:
+                ward = address_wards[member_address]
+            else:
+                ward = ward_for_address(member_address)
             if ward:
                 logging.debug(
                     "person=%s: assigned ward '%s' by geocoding '%s'",
@@ -93,8 +208,9 @@ def wards_for_member(member: Member,
             logging.error("person=%s: couldn't geocode ward from address '%s'",
                           member.identifier, member_address)
     if member.zipcode:
+        sig_wards_for_zip = significant_wards_for_zip(min_ward_sqft)
         if member.zipcode in sig_wards_for_zip:
-            wards = sig_wards_for_zip[member.zipcode]
+            wards = list(sig_wards_for_zip[member.zipcode])
             logging.debug("person=%s: assigned wards '%s' based on zip '%s'",
                           member.identifier, json.dumps(wards), member.zipcode)
             return (wards, WardTaggingStrategy.ZIPCODE)
@@ -129,3 +245,28 @@ def get_ward_id_to_uuid_map(client: Client) -> WardToTagMap:
     logging.debug("Successfully found 50 ward tags in the database: %s",
                   pformat(ward_tags))
     return ward_tags
+
+
+def get_ward_taggings_snapshot(
+        client: Client, ward_to_tag_map: WardToTagMap) -> PersonToTagsMap:
+    person_to_tags: PersonToTagsMap = {}
+    num_requests = 0
+    for ward_num, tag_uuid in sorted(ward_to_tag_map.items()):
+        page_index = 1
+        while True:
+            logging.debug("Requesting taggings for ward=%s, page=%s",
+                          ward_num, page_index)
+            taggings_response = client.get_taggings_for_tag(tag_uuid,
+                                                            page_index)
+            num_requests += 1
+            embedded = taggings_response.get("_embedded", {})
+            for tagging in embedded.get("osdi:taggings", []):
+                person_href = tagging["_links"]["osdi:person"]["href"]
+                person_uuid = person_href.split("/")[-1]
+                person_to_tags.setdefault(person_uuid, set()).add(tag_uuid)
+            if page_index >= taggings_response.get("total_pages", 1):
+                break
+            page_index += 1
+    logging.info("Found ward taggings for %s people, using %s requests",
+                 len(person_to_tags), num_requests)
+    return person_to_tags